@@ -4,16 +4,16 @@
 
 ################################################################################
 
-import os
-import time
-
+import history
 import how_busy
+import planner
+import job_logs
 import scheduler
+import simulate
+import async_daemon
+from daemon import Daemon
 
-from sd.common import itercount, warn, gohome, quickrun, check_install
-from sd.common import shell, rint, read_csv, tman
-
-from sd.chronology import local_time, msleep, fmt_time
+from sd.common import itercount, gohome, convert_user_size, error
 from sd.arg_master import easy_parse
 
 def parse_args():
@@ -24,9 +24,45 @@ def parse_args():
 	]
 	args = [\
 	['polling', 'polling_rate', float, 1],
-	"How often to check (minutes)",
+	"How often to check while an app is waiting on its requirements (minutes)",
+	['maxsleep', 'max_sleep', float, 15],
+	"Longest time to sleep when nothing is scheduled (minutes)",
 	['idle', '', float, 0],
 	"How long to wait before going to sleep (minutes) 0=Disable",
+	['engine', '', str, 'threads'],
+	"How to run jobs: threads or asyncio",
+	['jobs', 'max_jobs', int, 0],
+	"Maximum number of jobs to run at the same time. Others wait in line. 0=No limit",
+	['idlesource', 'idle_source', str, 'auto'],
+	"Where to read the idle time from: auto, x11, logind, input, xprintidle or fake",
+	['vector', '', int, 256],
+	"Check all the jobs at once with NumPy when the schedule has at least this many. 0=Never",
+	['simulate', '', str, ''],
+	"Run the schedule on a simulated clock for this long (like 30d) and show when each app would run",
+	['timeline', '', str, ''],
+	"With --simulate: file of when the computer is active, unplugged or closed. See simulate.py",
+	['plan', '', str, ''],
+	"Show every time window coming up in this long (like 14d) for all of the apps and quit",
+	['export', '', str, ''],
+	"With --plan: also save the windows to a .csv or .json file",
+	['logrun', 'log_run', str, '10M'],
+	"Most output saved from one run of an app, for stdout and stderr each (like 10M)",
+	['logjob', 'log_job', str, '50M'],
+	"Most old log files kept on disk for each app (like 50M)",
+	['logkeep', 'log_keep', int, 10],
+	"Number of old compressed log files to keep for each app",
+	['history', '', str, ''],
+	"Show how long each app with this in its name takes to run and how often it fails (* for all) and quit",
+	['metrics', '', str, ''],
+	"Write counters and timings to this file every minute for node_exporter's textfile collector",
+	['profile', '', bool],
+	"Time each part of the main loop. Send SIGUSR1 to print the timings",
+	['cprofile', '', int, 0],
+	"With --profile: also run cProfile for this many loops and save the stats to state/lazycron.pstats",
+	['netinclude', 'net_include', str, ','.join(how_busy.NET_INCLUDE)],
+	"Network interfaces to count when checking if the computer is busy, comma seperated patterns like wl*,eth0",
+	['netexclude', 'net_exclude', str, ','.join(how_busy.NET_EXCLUDE)],
+	"Network interfaces to leave out. Default is loopback, docker and virtual machine bridges",
 	['verbose', '', int, 1],
 	"What messages to print",
 	['testing', '', bool],
@@ -40,134 +76,37 @@ def parse_args():
 					  description='Monitor the system for idle states and run scripts at the best time.')
 
 
-def read_schedule(schedule_apps, schedule_file):
-	"Read the schedule file"
-	new_sched = []
-	headers = "time frequency date reqs path".split()
-	for line in read_csv(schedule_file, headers=headers, delimiter=("\t", " " * 4), merge=True):
-		print('\n\nData =', repr(line))
-		if not all(line.values()):
-			warn("Empty columns must have a * in them")
-			continue
-		if len(line) >= 3:
-			for proc in schedule_apps:
-				if line == proc.args:
-					new_sched.append(proc)
-					break
-			else:
-				proc = scheduler.Scheduler(line)
-				proc.print()
-				new_sched.append(proc)
-		else:
-			print("Could not process:", line)
-	return new_sched
-
-
-def is_busy(max_net=100, max_disk=1):
-	'''Return True if disk or network usage above defaults
-	max_net = Network usage in KB/s
-	max_disk = Disk usage in MB/s
-	'''
-	net_usage = how_busy.get_network_usage(5, 4)     # KB/s
-	disk_usage = how_busy.all_disk_usage(5, 4)       # MB/s
-
-	if net_usage < max_net and disk_usage < max_disk:
-		return False
-	else:
-		print("Network Usage:", net_usage)
-		print("Disk usage:   ", disk_usage)
-	return True
-
-
 def main(args):
-	polling_rate = args.polling_rate * 60
-	idle_sleep = args.idle * 60
-	if idle_sleep:
-		check_install('iostat', 'sar',
-					  msg='''sudo apt install sysstat sar
-					  --idle requires iostat () to determine if the computer can be put to sleep.''')
-	check_install('xprintidle', msg="sudo apt install xprintidle")
-
-	schedule_file = args.schedule	# Tab seperated input file
-	testing_mode = args.testing		# Don't actually do anything
-
-	sleep_time = polling_rate   # Time to rest at the end of every loop
-	idle = 0                    # Seconds without user inteaction.
-	elapsed = 0                 # Total time Computer has spent not idle
-	total_idle = 0
-	last_idle = 0
-	timestamp = time.time()     # Timestamp at start of loop
-	last_schedule_read = 0      # last time the schedule file was read
-	schedule_apps = []
-	cur_day = time.strftime('%d')
+	if args.history:
+		history.main(args)
+		return
+
+	if args.plan:
+		planner.main(args)
+		return
+
+	if args.simulate:
+		simulate.simulate(args)
+		return
+
+	how_busy.configure_network(include=args.net_include, exclude=args.net_exclude)
+	try:
+		job_logs.configure(run=convert_user_size(args.log_run, default='mb'),
+						   job=convert_user_size(args.log_job, default='mb'),
+						   keep=args.log_keep)
+	except ValueError as err:
+		error(err)
+
+	if args.engine == 'asyncio':
+		async_daemon.main(args)
+		return
+
+	lazy = Daemon(args)
 	for counter in itercount():
 		# Sleep at the end of every loop
-		if counter:
-			missing = msleep(sleep_time)
-			if missing:
-				if missing > 5:
-					print("Unaccounted for time during sleep:", fmt_time(missing))
-				# Loop again to avoid edge case where the machine wakes up and is immediately put back to sleep
-				total_idle = float(shell('xprintidle')) / 1000
-				timestamp = time.time()
-				continue
-
-			# Get idle time and calculate elapsed time
-			last_idle = total_idle
-			total_idle = float(shell('xprintidle')) / 1000
-
-			if total_idle > last_idle:
-				idle = total_idle - last_idle
-			else:
-				idle = total_idle
-			new_time = time.time()
-			elapsed += new_time - timestamp - idle
-			if counter == 1:
-				elapsed = 0
-			timestamp = new_time
-			if args.verbose >= 2:   # not (counter - 1) % 10:
-				print(local_time(), 'Elapsed:', fmt_time(elapsed), 'Idle:', rint(total_idle))
-			if time.strftime('%d') != cur_day:
-				cur_day = time.strftime('%d')
-				print(time.strftime('\n\nToday is %A, %-m-%d'))
-				print('#'*80)
-
-
-		# Read the schedule file if it's been updated
-		if os.path.getmtime(schedule_file) > last_schedule_read:
-			if counter:
-				print("\n\nSchedule file updated:")
-			last_schedule_read = time.time()
-			schedule_apps = read_schedule(schedule_apps, schedule_file)
-
-
-		# Run scripts if enough elapsed time has passed
-		for proc in schedule_apps:
-			if proc.in_window() and proc.next_elapsed <= elapsed:
-				if args.skip and counter < 2:
-					testing = True
-				else:
-					testing = testing_mode
-				proc.run(elapsed=elapsed, idle=total_idle, polling_rate=polling_rate, testing_mode=testing)
-
-
-		# Put the computer to sleep after checking to make sure nothing is going on.
-		if idle_sleep and total_idle > idle_sleep:
-			if scheduler.is_plugged():
-				# Plugged mode waits for idle system.
-				ready, results = tman.query(is_busy, max_age=sleep_time * 1.5)
-				if ready:
-					if not results:
-						print("Going to sleep\n")
-						if not testing_mode:
-							quickrun('systemctl', 'suspend')
-					else:
-						print("Too busy to sleep")
-			else:
-				# Battery Mode doesn't wait for idle system.
-				print("Idle and unplugged. Going to sleep.")
-				if not testing_mode:
-					quickrun('systemctl', 'suspend')
+		if counter and not lazy.sleep(counter):
+			continue
+		lazy.tick(counter)
 
 
 
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+# Measure what each run of a job cost: CPU time, peak memory and disk I/O.
+# Jobs are reaped with os.wait4 so the kernel hands over the totals for the job and every child it waited on.
+
+import os
+import time
+import asyncio
+from collections import namedtuple
+
+from sd.chronology import fmt_time
+
+BLOCK = 512         # ru_inblock and ru_oublock count 512 byte blocks
+
+
+Usage = namedtuple('Usage', 'wall user system max_rss read_bytes write_bytes')
+'''
+wall        = Seconds from start to finish
+user        = CPU seconds in user mode
+system      = CPU seconds in the kernel
+max_rss     = Peak resident memory of the biggest process in bytes. Never less than the daemon's own size,
+              because the kernel counts the forked copy of the daemon before it turns into the job.
+read_bytes  = Bytes read from disk (not the page cache)
+write_bytes = Bytes written to disk
+'''
+
+
+def from_rusage(rusage, wall):
+	"Convert the struct returned by os.wait4 into a Usage"
+	return Usage(wall=wall, user=rusage.ru_utime, system=rusage.ru_stime, max_rss=rusage.ru_maxrss * 1024,
+				 read_bytes=rusage.ru_inblock * BLOCK, write_bytes=rusage.ru_oublock * BLOCK)
+
+
+def fmt_bytes(num):
+	for unit in ('B', 'KiB', 'MiB', 'GiB'):
+		if num < 1024 or unit == 'GiB':
+			return (str(int(num)) if unit == 'B' else '{:.1f}'.format(num)) + ' ' + unit
+		num /= 1024
+	return None
+
+
+def describe(usage):
+	"One line summary of a Usage"
+	return ' '.join(('Took', fmt_time(usage.wall) + '.', 'CPU:', fmt_time(usage.user), 'user,',
+					 fmt_time(usage.system), 'system. Max RSS:', fmt_bytes(usage.max_rss) + '. Disk:',
+					 fmt_bytes(usage.read_bytes), 'read,', fmt_bytes(usage.write_bytes), 'written'))
+
+
+def reaped(proc, status):
+	"Tell a subprocess.Popen that it has been reaped so it won't try to wait on the pid again"
+	proc.returncode = os.waitstatus_to_exitcode(status)
+	return proc.returncode
+
+
+def wait_proc(proc, started):
+	"Wait for a subprocess.Popen to exit. Returns (return code, Usage)"
+	while True:
+		try:
+			_pid, status, rusage = os.wait4(proc.pid, 0)
+			break
+		except InterruptedError:
+			continue
+	return reaped(proc, status), from_rusage(rusage, time.monotonic() - started)
+
+
+async def wait_proc_async(proc, started):
+	'''Same as wait_proc without blocking the event loop.
+	Uses a pidfd to find out when the process exits, falling back on a thread if the kernel is too old.'''
+	loop = asyncio.get_running_loop()
+	try:
+		pidfd = os.pidfd_open(proc.pid)
+	except (AttributeError, OSError):
+		return await loop.run_in_executor(None, wait_proc, proc, started)
+
+	exited = loop.create_future()
+	loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(True))
+	try:
+		await exited
+	finally:
+		loop.remove_reader(pidfd)
+		os.close(pidfd)
+	_pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+	return reaped(proc, status), from_rusage(rusage, time.monotonic() - started)
@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+# Alternative engine for LazyCron that runs everything on one asyncio event loop.
+# Jobs are subprocesses watched by the loop instead of one thread each.
+# Usage: ./LazyCron.py --engine asyncio
+
+import os
+import time
+import asyncio
+import subprocess
+
+import accounting
+import job_logs
+import job_limits
+import scheduler
+from daemon import Daemon
+from wakeup import missing_time
+
+from sd.common import itercount
+from sd.chronology import cur_time, get_clock
+
+
+async def open_reader(pipe):
+	"Return an asyncio.StreamReader for a pipe from subprocess.Popen"
+	reader = asyncio.StreamReader()
+	await asyncio.get_running_loop().connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+	return reader
+
+
+async def run_proc_async(cmd, log, limits=None):
+	'''Same as scheduler.run_proc, but as a coroutine.
+	The job is started with Popen instead of asyncio's subprocess so it can be reaped with os.wait4 for its usage.'''
+	run = job_logs.get_log(log).start_run(cmd)
+	started = time.monotonic()
+	proc = subprocess.Popen(job_limits.command(cmd, limits, os.path.basename(log)),
+							stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	stdout, stderr = await asyncio.gather(open_reader(proc.stdout), open_reader(proc.stderr))
+	await job_logs.stream_output_async(stdout, stderr, run)
+	code, usage = await accounting.wait_proc_async(proc, started)
+	run.finish(code, usage)
+
+	if code:
+		# warn() pauses after printing, so keep it off the loop
+		loop = asyncio.get_running_loop()
+		zcmd = await loop.run_in_executor(None, scheduler.failure_popup, cmd, code, run.err_name)
+		if zcmd:
+			popup = await asyncio.create_subprocess_exec(*zcmd)
+			await popup.wait()
+	return run
+
+
+class AsyncJob:
+	"Wrap a job's task so Scheduler.running() can check on it like a thread"
+
+	def __init__(self, coro, on_done=None):
+		self.task = asyncio.get_running_loop().create_task(coro)
+		self.task.add_done_callback(self.finished)
+		self.on_done = on_done
+
+	def finished(self, task):
+		run = None
+		if not task.cancelled():
+			if task.exception():
+				print("Job failed to run:", repr(task.exception()))
+			else:
+				run = task.result()
+		if self.on_done:
+			self.on_done(run)
+
+	def is_alive(self):
+		return not self.task.done()
+
+
+class AsyncDaemon(Daemon):
+	"Same logic as Daemon, but the timers and jobs all come from the event loop"
+
+	def __init__(self, args):
+		super().__init__(args)
+		self.event = None           # Set when something wakes the loop early
+		self.pending = []           # Reasons for being woken early
+
+	def attach(self):
+		"Start listening for wakeups and file changes. Must be called inside the loop."
+		loop = asyncio.get_running_loop()
+		self.event = asyncio.Event()
+		loop.add_reader(self.wakeup.pipe_r, self.woken, self.wakeup.read_woken)
+		if self.wakeup.inotify is not None:
+			loop.add_reader(self.wakeup.inotify, self.woken,
+							lambda: ['changed ' + name for name in self.wakeup.read_changes()])
+
+	def woken(self, reader):
+		reasons = reader()
+		if reasons:
+			self.pending += reasons
+			self.event.set()
+
+	async def sleep_async(self, counter):
+		"Same as Daemon.sleep but waits on the event loop"
+		cap = self.sleep_cap()
+		start = cur_time()
+		mono = get_clock().monotonic()
+		when, _reason = self.wakeup.earliest()
+		deadline = min(when, start + cap)
+		while not self.pending:
+			remaining = deadline - cur_time()
+			if remaining <= 0:
+				break
+			self.event.clear()
+			# The loop clock stops during suspend, so check the wall clock at least every cap seconds
+			try:
+				await asyncio.wait_for(self.event.wait(), min(remaining, cap))
+			except asyncio.TimeoutError:
+				pass
+		self.wakeup.reasons = self.pending or ['timer']
+		self.pending = []
+		self.wakeup.pop_due()
+		return self.woke(counter, missing_time(start, mono))
+
+	def launch(self, cmd, log, proc=None):
+		return AsyncJob(run_proc_async(cmd, log, proc.limits if proc else None),
+						on_done=lambda run: self.job_done(proc, run))
+
+
+async def run_forever(lazy):
+	lazy.attach()
+	for counter in itercount():
+		if counter and not await lazy.sleep_async(counter):
+			continue
+		lazy.tick(counter)
+
+
+def main(args):
+	asyncio.run(run_forever(AsyncDaemon(args)))
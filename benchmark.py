@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+# Measure the sd.chronology parsers and formatters that run on every schedule load and log line.
+# Usage: ./benchmark.py           Compare against the saved baseline
+#        ./benchmark.py --save    Save the results as the new baseline
+
+import os
+import sys
+import json
+import time
+import tracemalloc
+
+from sd.common import gohome, mkdir
+from sd.arg_master import easy_parse
+from sd import chronology
+from sd.chronology import convert_user_time, convert_ut_range, udate, match_conversion, fmt_time, local_time
+
+BASELINE_FILE = 'state/benchmark.json'
+
+# Expressions like the ones found in real schedule files
+TIMES = ['1h', '30m', '2 hours', '1.5 days', '3pm', '3:14 am', '12am', '11:30', '45 minutes', '1 week',
+		 '5m', '8h', '90s', '2 fortnight', '0.5 years']
+RANGES = ['8pm-3', '8:30pm-3am', '-5pm', '4-6pm', '1-3am', '2pm-4', '11:30-11:34', '9am-6pm', '10pm-7am', '12am-1am']
+DATES = ['m', 'f', 'sat', 'sunday', 'tu', 'th', '2nd thursday', '3rd friday', '1st', '2nd', '15', 'march 14',
+		 'jan 2nd', 'december 25', '4th monday']
+UNITS = ['min', 'hou', 'fort', 'jiff', 'gigasecond', 'decasecond', 'tropicalyears', 'ms']
+SECONDS = [0.5, 59, 61, 3599, 3600 * 5.5, 86400, 86400 * 3.25, 86400 * 40, 86400 * 400, 1e9]
+OFFSETS = [60, 3600 * 5, 86400 * 2, 86400 * 10, 86400 * 60]
+
+
+def uncached(name):
+	"Return the function underneath a cached parser in sd.chronology so the parsing itself gets measured"
+	func = getattr(chronology, name)
+	return getattr(func, '__wrapped__', func)
+
+
+SUITE = dict(
+	convert_user_time=(convert_user_time, [(text,) for text in TIMES]),
+	convert_ut_range=(convert_ut_range, [(text,) for text in RANGES]),
+	udate=(udate, [(text,) for text in DATES]),
+	match_conversion=(lambda text: match_conversion(text, convert_user_time.conversions), [(text,) for text in UNITS]),
+	fmt_time=(fmt_time, [(num,) for num in SECONDS]),
+	local_time=(lambda offset: local_time(time.time() + offset), [(num,) for num in OFFSETS]),
+	parse_user_time=(lambda text: uncached('_convert_user_time')(text, 'seconds'), [(text,) for text in TIMES]),
+	parse_ut_range=(lambda text: uncached('_convert_ut_range')(text), [(text,) for text in RANGES]),
+	parse_udate=(lambda text: uncached('_parse_udate')(text), [(text,) for text in DATES]),
+)
+
+
+def ops_per_sec(func, corpus, min_time=0.2, repeat=5):
+	"Best of repeat runs, each going through the corpus until min_time has passed"
+	best = 0
+	for _ in range(repeat):
+		calls = 0
+		start = time.perf_counter()
+		while True:
+			for args in corpus:
+				func(*args)
+			calls += len(corpus)
+			elapsed = time.perf_counter() - start
+			if elapsed >= min_time:
+				break
+		best = max(best, calls / elapsed)
+	return best
+
+
+def allocations(func, corpus):
+	"Return the average peak memory allocated during a call in bytes, including memory freed before it returned"
+	tracemalloc.start()
+	peak = 0
+	for args in corpus:
+		tracemalloc.reset_peak()
+		before = tracemalloc.get_traced_memory()[0]
+		func(*args)
+		peak += tracemalloc.get_traced_memory()[1] - before
+	tracemalloc.stop()
+	return peak / len(corpus)
+
+
+def run(names=None, min_time=0.2):
+	"Benchmark each function and return dict of name to results"
+	results = dict()
+	for name, (func, corpus) in SUITE.items():
+		if names and name not in names:
+			continue
+		for args in corpus:
+			func(*args)         # Warm up any tables built on the first call
+		ops = ops_per_sec(func, corpus, min_time)
+		results[name] = dict(ops=round(ops), bytes=round(allocations(func, corpus)))
+	return results
+
+
+def compare(results, baseline, tolerance=0.2):
+	"Print the results next to the baseline. Returns list of functions that got slower or use more memory"
+	regressions = []
+	print('Function'.ljust(20), 'ops/sec'.rjust(10), 'baseline'.rjust(10), 'change'.rjust(8),
+		  'bytes/call'.rjust(11), 'baseline'.rjust(10))
+	for name, res in results.items():
+		old = baseline.get(name)
+		change = ''
+		flag = ''
+		if old:
+			ratio = res['ops'] / old['ops'] - 1
+			change = '{:+.0%}'.format(ratio)
+			if ratio < -tolerance or res['bytes'] > old['bytes'] * (1 + tolerance) + 64:
+				flag = '  <-- REGRESSION'
+				regressions.append(name)
+		print(name.ljust(20), str(res['ops']).rjust(10), str(old['ops'] if old else '-').rjust(10), change.rjust(8),
+			  str(res['bytes']).rjust(11), str(old['bytes'] if old else '-').rjust(10) + flag)
+	return regressions
+
+
+def parse_args():
+	"Parse arguments"
+	positionals = [\
+	["names", '', list, []],
+	"Functions to benchmark. Default is all of them."
+	]
+	args = [\
+	['save', '', bool],
+	"Save the results as the new baseline",
+	['baseline', '', str, BASELINE_FILE],
+	"Baseline file to compare against",
+	['tolerance', '', float, 20],
+	"Percent slower (or more memory) than the baseline before it counts as a regression",
+	['mintime', 'min_time', float, 0.2],
+	"Seconds to spend on each timing run",
+	]
+	return easy_parse(args,
+					  positionals,
+					  usage='<function names>, options...',
+					  description='Benchmark the time parsing and formatting functions in sd/chronology.py')
+
+
+def main(args):
+	results = run(args.names, args.min_time)
+	try:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+	except FileNotFoundError:
+		baseline = dict()
+		print("No baseline saved yet. Run with --save to make one.\n")
+	regressions = compare(results, baseline, args.tolerance / 100)
+
+	if args.save:
+		if os.path.dirname(args.baseline):
+			mkdir(os.path.dirname(args.baseline))
+		baseline.update(results)
+		with open(args.baseline, 'w') as f:
+			json.dump(baseline, f, indent=4, sort_keys=True)
+		print("\nSaved baseline to", args.baseline)
+	elif regressions:
+		print("\nRegressed compared to the baseline:", ', '.join(regressions))
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	gohome()
+	main(parse_args())
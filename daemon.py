@@ -0,0 +1,481 @@
+#!/usr/bin/python3
+# The LazyCron main loop: track idle and active time and run apps when their time comes.
+
+import os
+import re
+import time
+import signal
+import atexit
+import functools
+from collections import Counter
+
+import metrics
+import sampler
+import scheduler
+import idle_time
+from wakeup import WakeQueue
+from run_queue import RunQueue
+from journal import Journal
+from history import RunHistory, HISTORY_FILE
+from job_table import JobTable
+from schedule_cache import ScheduleCache
+from profiler import PROFILER
+
+from sd.common import warn, error, quickrun, rint, read_csv
+from sd.chronology import local_time, fmt_time, seconds_since_midnight, cur_time, localtime
+
+
+def parse_row(row):
+	'''Turn a row of the schedule file into a dict of columns.
+	The path is always the last column. The optional priority and limits columns go before it in either order:
+	a whole number is the priority and anything else is the limits.
+	limits is only added when there is one, so lines without it keep their job ids.'''
+	row = [str(item) for item in row]
+	if len(row) < 5:
+		return None
+	line = dict(zip("time frequency date reqs".split(), row[:4]))
+	line['priority'] = '*'
+	for item in row[4:-1]:
+		key = 'priority' if re.fullmatch(r'\*|[-+]?\d+', item.strip()) else 'limits'
+		if line.get(key, '*') == '*':
+			line[key] = item
+		elif item.strip() != '*':
+			print("Warning! Unused item while reading line:", item)
+	line['path'] = row[-1]
+	return line
+
+
+def read_lines(schedule_file):
+	"Return (job id, line) for every valid line in the schedule file"
+	lines = []
+	ids = set()
+	for row in read_csv(schedule_file, delimiter=("\t", " " * 4), merge=True):
+		line = parse_row(row)
+		if not line:
+			print("Could not process:", row)
+			continue
+		if not all(line.values()):
+			warn("Empty columns must have a * in them")
+			continue
+		key = scheduler.job_id(line)
+		if key in ids:
+			print("Skipping duplicate line:", line['path'])
+			continue
+		ids.add(key)
+		lines.append((key, line))
+	return lines
+
+
+def read_schedule(index, schedule_file, saved=None, verbose=1, cache=None):
+	'''Read the schedule file, only building new apps for lines that were added or changed.
+	index = dict of job ids to apps from the last read. Unchanged apps keep their state.
+	saved = dict of job ids to state from the journal for restoring new jobs
+	cache = ScheduleCache of previously parsed lines
+	Returns the new index'''
+	lines = cache.get_lines(schedule_file) if cache else None
+	if lines is None:
+		lines = read_lines(schedule_file)
+		if cache:
+			cache.set_lines(lines)
+
+	new_index = dict()
+	new_procs = []
+	for key, line in lines:
+		proc = index.get(key)
+		if not proc:
+			proc = scheduler.Scheduler(line, parsed=cache.get_job(key) if cache else None)
+			if saved:
+				proc.restore(saved.get(key))
+			new_procs.append(proc)
+		new_index[key] = proc
+
+	# A line that was removed with the same path as a new line counts as changed. Each removed line matches once
+	removed = [proc for key, proc in index.items() if key not in new_index]
+	removed_paths = Counter(proc.path for proc in removed)
+	changed = 0
+	for proc in new_procs:
+		if removed_paths[proc.path]:
+			removed_paths[proc.path] -= 1
+			changed += 1
+
+	with PROFILER.phase('print'):
+		if len(new_procs) <= 16:
+			for proc in new_procs:
+				print()
+				proc.print()
+		elif verbose >= 2:
+			print()
+			scheduler.print_status(new_procs)
+		print('\nSchedule:', len(new_procs) - changed, 'added,', changed, 'changed,', len(removed) - changed, 'removed,',
+			  len(new_index) - len(new_procs), 'unchanged')
+	if cache:
+		if new_procs:
+			cache.set_jobs(new_index.values())
+		cache.save()
+	return new_index
+
+
+def too_busy(net_usage, disk_usage, max_net=100, max_disk=1):
+	'''Return True if disk or network usage is above the limits
+	max_net = Network usage in KB/s
+	max_disk = Disk usage in MB/s
+	'''
+	metrics.NETWORK_USAGE.set(net_usage)
+	metrics.DISK_USAGE.set(disk_usage)
+	if net_usage < max_net and disk_usage < max_disk:
+		metrics.BUSY_RESULTS.inc('quiet')
+		return False
+	else:
+		metrics.BUSY_RESULTS.inc('busy')
+		print("Network Usage:", net_usage)
+		print("Disk usage:   ", disk_usage)
+	return True
+
+
+JOURNAL_FILE = 'state/lazycron.journal'
+CACHE_FILE = 'state/schedule.cache'
+CHECKPOINT = 600                # Seconds between saving the active time
+METRICS_INTERVAL = 60           # Seconds between writing the metrics file
+BUSY_WINDOW = 20                # Seconds of disk and network activity averaged to decide if the computer is busy
+
+
+class Daemon:
+	'''Keep track of time spent idle and in use, run the scheduled apps and
+	work out how long it can sleep before anything could possibly need doing.'''
+
+	def __init__(self, args):
+		self.args = args
+		self.polling_rate = args.polling_rate * 60  # How often to check while something is waiting to run
+		self.max_sleep = args.max_sleep * 60        # Longest sleep when nothing is going on
+		self.idle_sleep = args.idle * 60
+		self.schedule_file = args.schedule          # Tab seperated input file
+		self.testing_mode = args.testing            # Don't actually do anything
+
+		self.idle = 0                   # Seconds without user inteaction since last check
+		self.elapsed = 0                # Total time Computer has spent not idle
+		self.total_idle = 0
+		self.timestamp = cur_time()     # Timestamp at start of loop
+		self.schedule_mtime = None      # Modification time of the schedule file when last read
+		self.index = dict()             # Job ids to apps
+		self.schedule_apps = []
+		self.table = None               # JobTable for big schedules
+		self.cache = self.open_cache()
+		self.cur_day = localtime().tm_mday
+		self.armed = False              # Something is due, but waiting on a requirement
+		self.queue = RunQueue(args.max_jobs)
+
+		# Pick up where the last run left off
+		self.journal = self.open_journal()
+		self.saved = self.journal.replay()
+		self.start_elapsed = self.elapsed = self.journal.elapsed
+		self.history = self.open_history()
+
+		self.idle_source = self.open_idle_source()
+		self.sensors = self.open_sensors()
+		self.sampler = None             # Background LoadSampler
+		if self.idle_sleep:
+			self.start_sampler()
+		self.metrics = self.open_metrics()
+		self.wakeup = WakeQueue()
+		self.watch_schedule()
+		if args.profile:
+			PROFILER.enable(cprofile=args.cprofile)
+			signal.signal(signal.SIGUSR1, self.print_profile)
+			print("Profiling the main loop. Send SIGUSR1 to print the timings: kill -USR1", os.getpid())
+
+
+	# Where the daemon's state and measurements come from. The simulator overrides these so nothing real is touched
+
+	def open_journal(self):
+		return Journal(JOURNAL_FILE, readonly=self.testing_mode)
+
+	def open_history(self):
+		history = RunHistory(HISTORY_FILE, readonly=self.testing_mode)
+		atexit.register(history.flush)
+		return history
+
+	def open_cache(self):
+		return ScheduleCache(CACHE_FILE, readonly=self.testing_mode)
+
+	def open_idle_source(self):
+		try:
+			return idle_time.open_source(self.args.idle_source)
+		except ValueError as err:
+			error(err)
+		return None
+
+	@staticmethod
+	def open_sensors():
+		"Lid and power cord for the closed and plugged requirements"
+		return scheduler.SENSORS
+
+	def open_metrics(self):
+		return metrics.TextfileWriter(self.args.metrics, METRICS_INTERVAL) if self.args.metrics else None
+
+	def watch_schedule(self):
+		"Wake up when the schedule file changes or on SIGHUP"
+		if not self.wakeup.watch(self.schedule_file):
+			print("Could not watch", self.schedule_file, "for changes. It will be checked every",
+				  fmt_time(self.max_sleep))
+		signal.signal(signal.SIGHUP, lambda *_: self.wakeup.wake('SIGHUP'))
+
+
+	def print_profile(self, *_args):
+		"Signal handler to print the profiler timings after the next tick"
+		PROFILER.request()
+		self.wakeup.wake('SIGUSR1')
+
+
+	def sleep_cap(self):
+		"Return the longest time to sleep in seconds"
+		if self.armed or (self.idle_sleep and self.total_idle >= self.idle_sleep):
+			cap = self.polling_rate
+		else:
+			cap = self.max_sleep
+		if self.args.verbose >= 2:
+			when, reason = self.wakeup.earliest()
+			when = min(when, cur_time() + cap)
+			with PROFILER.phase('print'):
+				print(local_time(), 'Sleeping', fmt_time(when - cur_time()), 'until', reason or 'next check')
+		return cap
+
+
+	def sleep(self, counter):
+		'''Sleep until the next interesting instant.
+		Returns False if time went missing (suspend) and the loop should start over.'''
+		missing = self.wakeup.sleep(self.sleep_cap())
+		return self.woke(counter, missing)
+
+
+	def woke(self, counter, missing):
+		"Update the idle and elapsed time after sleeping. Returns False to start the loop over"
+		if self.args.verbose >= 2 and self.wakeup.reasons != ['timer']:
+			print('Woken by:', ', '.join(self.wakeup.reasons))
+		if missing:
+			if missing > 5:
+				print("Unaccounted for time during sleep:", fmt_time(missing))
+			# Loop again to avoid edge case where the machine wakes up and is immediately put back to sleep
+			self.total_idle = self.query_idle()
+			self.timestamp = cur_time()
+			return False
+
+		# Get idle time and calculate elapsed time
+		last_idle = self.total_idle
+		self.total_idle = self.query_idle()
+
+		if self.total_idle > last_idle:
+			self.idle = self.total_idle - last_idle
+		else:
+			self.idle = self.total_idle
+		new_time = cur_time()
+		self.elapsed += new_time - self.timestamp - self.idle
+		if counter == 1:
+			self.elapsed = self.start_elapsed
+		self.timestamp = new_time
+		if new_time - self.journal.saved > CHECKPOINT:
+			self.journal.checkpoint(self.elapsed)
+		with PROFILER.phase('print'):
+			if self.args.verbose >= 2:
+				print(local_time(), 'Elapsed:', fmt_time(self.elapsed), 'Idle:', rint(self.total_idle))
+			if localtime().tm_mday != self.cur_day:
+				self.cur_day = localtime().tm_mday
+				print(local_time(user_format='\n\nToday is %A, %-m-%d'))
+				print('#'*80)
+		return True
+
+
+	def query_idle(self):
+		"Read the idle time and keep track of how long it took"
+		with metrics.IDLE_QUERY.time(self.idle_source.name), PROFILER.phase('idle query'):
+			return self.idle_source.query()
+
+
+	def start_sampler(self):
+		"Start measuring the disks, network and CPU in the background. Returns the sampler"
+		if not self.sampler:
+			self.sampler = sampler.get_sampler()
+		return self.sampler
+
+
+	def query_busy(self):
+		'''Check the disk and network activity measured by the sampler. Returns (ready, busy)
+		Not ready until the sampler has been running for BUSY_WINDOW seconds'''
+		load = self.start_sampler()
+		if not load.warmed_up(BUSY_WINDOW):
+			return False, None
+		with metrics.BUSY_PROBE.time():
+			return True, too_busy(load.average('net', BUSY_WINDOW), load.average('disk', BUSY_WINDOW))
+
+
+	def job_done(self, proc, run):
+		"Called when a job finishes. Record the run and wake up if something is waiting for the slot"
+		if run and proc:
+			proc.usage = run.usage
+			self.history.record_run(proc.name, run)
+			metrics.JOB_DURATION.observe(run.end_time - run.start_time, proc.name)
+			if run.code:
+				metrics.JOBS_FAILED.inc()
+		if self.queue:
+			self.wakeup.wake('job finished')
+
+
+	def launch(self, cmd, log, proc=None):
+		"Start a job and return an object with is_alive()"
+		return scheduler.launch_thread(cmd, log, on_done=lambda run: self.job_done(proc, run),
+									   limits=proc.limits if proc else None)
+
+
+	def tick(self, counter):
+		"Check the schedule, run anything that's due and queue up the next wakeups"
+		PROFILER.start_tick()
+		timer = time.perf_counter()
+		with PROFILER.phase('tick'):
+			self.check_schedule(counter)
+			self.queue_due()
+			with PROFILER.phase('start jobs'):
+				self.run_queue(counter)
+			self.check_suspend()
+			self.history.maybe_flush()
+			with PROFILER.phase('plan wakeups'):
+				self.plan_wakeups()
+		metrics.TICK.observe(time.perf_counter() - timer)
+		if self.metrics:
+			metrics.ELAPSED.set(self.elapsed)
+			metrics.IDLE.set(self.total_idle)
+			metrics.QUEUE_DEPTH.set(len(self.queue))
+			metrics.QUEUE_MAX.set(self.queue.max_depth)
+			metrics.RUNNING.set(sum(proc.running() for proc in self.schedule_apps))
+			if self.sampler and self.sampler.ewma('cpu') is not None:
+				metrics.CPU_USAGE.set(self.sampler.ewma('cpu'))
+			self.metrics.maybe_write()
+		PROFILER.end_tick()
+
+
+	def check_schedule(self, counter):
+		"Read the schedule file if it's been updated"
+		with PROFILER.phase('schedule mtime'):
+			mtime = os.path.getmtime(self.schedule_file)
+		if mtime != self.schedule_mtime:
+			if counter:
+				print("\n\nSchedule file updated:")
+			self.schedule_mtime = mtime
+			with PROFILER.phase('read schedule'):
+				self.index = read_schedule(self.index, self.schedule_file, self.saved, verbose=self.args.verbose,
+										   cache=self.cache)
+				self.schedule_apps = list(self.index.values())
+				self.journal.set_live(self.index)
+				self.table = None
+				if self.args.vector and len(self.schedule_apps) >= self.args.vector:
+					try:
+						self.table = JobTable(self.schedule_apps)
+					except ValueError as err:
+						print(err)
+
+
+	def queue_due(self):
+		"Queue up scripts if enough elapsed time has passed"
+		self.armed = False
+		with PROFILER.phase('windows'):
+			due = list(self.due_apps())
+		for proc, blocked in due:
+			if proc in self.queue:
+				# Still due, just waiting on a slot
+				continue
+			with PROFILER.phase('requirements'):
+				if blocked:
+					proc.blocked = blocked
+					ready = False
+				else:
+					ready = proc.ready(polling_rate=self.polling_rate, idle=self.total_idle, sensors=self.sensors)
+			if ready:
+				self.queue.push(proc)
+			else:
+				# Due, but a requirement wasn't met so check again soon
+				self.armed = True
+				metrics.JOBS_SKIPPED.inc(proc.blocked)
+
+
+	def check_suspend(self):
+		"Put the computer to sleep after checking to make sure nothing is going on."
+		if self.idle_sleep and self.total_idle > self.idle_sleep:
+			if self.sensors.is_plugged():
+				# Plugged mode waits for idle system.
+				ready, results = self.query_busy()
+				if ready:
+					if not results:
+						print("Going to sleep\n")
+						self.suspend()
+					else:
+						print("Too busy to sleep")
+			else:
+				# Battery Mode doesn't wait for idle system.
+				print("Idle and unplugged. Going to sleep.")
+				self.suspend()
+
+
+	def suspend(self):
+		"Put the computer to sleep"
+		if not self.testing_mode:
+			quickrun('systemctl', 'suspend')
+
+
+	def due_apps(self):
+		"Yield (proc, blocked) for each app that is due to run. blocked is the idle requirement it failed, if any"
+		if self.table:
+			yield from self.table.due(cur_time(), self.elapsed, self.total_idle)
+			return
+		for proc in self.schedule_apps:
+			if proc.in_window() and proc.next_elapsed <= self.elapsed:
+				yield proc, None
+
+
+	def run_queue(self, counter):
+		"Start as many queued jobs as there are free slots"
+		if not self.queue:
+			return
+		if self.args.skip and counter < 2:
+			testing = True
+		else:
+			testing = self.testing_mode
+		running = sum(proc.running() for proc in self.schedule_apps)
+		for proc, waited in self.queue.dispatch(running, keep=set(self.schedule_apps)):
+			self.start_job(proc, testing)
+			if waited >= 1:
+				with PROFILER.phase('print'):
+					print("\tWaited", fmt_time(waited), "for a free slot.", len(self.queue), "jobs still waiting.")
+		if self.queue and self.args.verbose >= 2:
+			with PROFILER.phase('print'):
+				print(self.queue.status())
+
+
+	def start_job(self, proc, testing):
+		"Start a job from the queue and remember that it ran"
+		if proc.start_proc(self.elapsed, testing_mode=testing, launch=functools.partial(self.launch, proc=proc)):
+			self.journal.record_run(proc.job_id, proc.last_run, self.elapsed)
+			metrics.JOBS_STARTED.inc()
+		else:
+			metrics.JOBS_SKIPPED.inc('testing')
+		if self.table:
+			self.table.update(proc)
+
+
+	def plan_wakeups(self):
+		"Queue up every instant that could change what the daemon should do"
+		wakeup = self.wakeup
+		wakeup.clear()
+		now = cur_time()
+		if self.table:
+			when, proc = self.table.next_wakeup(now, self.elapsed, self.total_idle)
+			if proc:
+				wakeup.push(when, 'next event for ' + proc.name)
+		else:
+			for proc in self.schedule_apps:
+				for when, reason in proc.wakeups(self.elapsed, self.total_idle):
+					wakeup.push(when, reason + ' for ' + proc.name)
+		if self.armed:
+			wakeup.push(now + self.polling_rate, 'requirements check')
+		if self.idle_sleep and self.total_idle < self.idle_sleep:
+			wakeup.push(now + self.idle_sleep - self.total_idle, 'idle sleep')
+		wakeup.push(now - seconds_since_midnight() + 86400, 'midnight')
+		if self.metrics:
+			wakeup.push(self.metrics.next_write(), 'metrics')
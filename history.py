@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+# Record every run of every job in an SQLite database and answer questions about them quickly.
+# Usage: ./LazyCron.py --history <name>     Show stats for apps with names containing <name>, or * for all
+
+import os
+import sys
+import time
+import sqlite3
+import threading
+
+from sd.common import mkdir
+from accounting import fmt_bytes
+from sd.chronology import local_time, fmt_time, cur_time
+
+HISTORY_FILE = 'state/history.db'
+PERCENTILES = (50, 90, 99)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+	id       INTEGER PRIMARY KEY,
+	job      TEXT NOT NULL,
+	start    REAL NOT NULL,
+	end      REAL NOT NULL,
+	duration REAL NOT NULL,
+	code     INTEGER,
+	bytes    INTEGER,
+	log      TEXT,
+	user_cpu    REAL,
+	system_cpu  REAL,
+	max_rss     INTEGER,
+	read_bytes  INTEGER,
+	write_bytes INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_job_start ON runs (job, start);
+CREATE INDEX IF NOT EXISTS runs_job_duration ON runs (job, duration, code);
+'''
+
+# Columns added after the first version of the table, with their types
+ADDED_COLUMNS = dict(user_cpu='REAL', system_cpu='REAL', max_rss='INTEGER', read_bytes='INTEGER', write_bytes='INTEGER')
+COLUMNS = ('job', 'start', 'end', 'duration', 'code', 'bytes', 'log') + tuple(ADDED_COLUMNS)
+
+'''
+runs_job_start answers "when did it last run" and runs_job_duration answers the percentiles and failure counts
+without touching the table itself, so a summary stays fast with hundreds of thousands of runs.
+'''
+
+
+class RunHistory:
+	'''SQLite database of finished runs.
+	Runs are saved in batches of batch runs, or every interval seconds, to keep the disk quiet.
+	readonly = Answer queries but never write (testing mode)'''
+
+	def __init__(self, filename=HISTORY_FILE, batch=64, interval=60, readonly=False):
+		self.filename = filename
+		self.batch = batch
+		self.interval = interval
+		self.readonly = readonly
+		self.pending = []               # Rows waiting to be written
+		self.flushed = cur_time()       # Time of the last write
+		self.lock = threading.Lock()    # Runs finish in their own threads
+		self._db = None
+
+	@property
+	def db(self):
+		"Connect on first use, so nothing is created on disk until there's something to save"
+		if self._db:
+			return self._db
+		if not self.readonly:
+			if os.path.dirname(self.filename):
+				mkdir(os.path.dirname(self.filename))
+			self._db = sqlite3.connect(self.filename, check_same_thread=False)
+			self._db.execute('PRAGMA journal_mode=WAL')
+			self._db.execute('PRAGMA synchronous=NORMAL')
+			self._db.executescript(SCHEMA)
+			self.upgrade()
+		elif os.path.exists(self.filename):
+			self._db = sqlite3.connect('file:' + self.filename + '?mode=ro', uri=True, check_same_thread=False)
+		else:
+			# Nothing saved yet, so answer from an empty database
+			self._db = sqlite3.connect(':memory:', check_same_thread=False)
+			self._db.executescript(SCHEMA)
+		return self._db
+
+	def upgrade(self):
+		"Add any columns missing from a database made by an older version"
+		have = {row[1] for row in self._db.execute('PRAGMA table_info(runs)')}
+		with self._db:
+			for name, kind in ADDED_COLUMNS.items():
+				if name not in have:
+					self._db.execute('ALTER TABLE runs ADD COLUMN ' + name + ' ' + kind)
+
+	def record(self, job, start, end, code, size, log, usage=None):
+		"Remember a finished run. It's written to disk with the next batch"
+		if self.readonly:
+			return
+		usage = (usage.user, usage.system, usage.max_rss, usage.read_bytes, usage.write_bytes) if usage else (None,) * 5
+		with self.lock:
+			self.pending.append((job, start, end, end - start, code, size, log) + usage)
+			full = len(self.pending) >= self.batch
+		if full:
+			self.flush()
+
+	def record_run(self, job, run):
+		"Record a job_logs.Run"
+		self.record(job, run.start_time, run.end_time, run.code, run.output_bytes, run.log.base, run.usage)
+
+	def flush(self):
+		"Write every pending run in one transaction"
+		with self.lock:
+			rows, self.pending = self.pending, []
+			self.flushed = cur_time()
+			if rows:
+				with self.db:
+					self.db.executemany('INSERT INTO runs (' + ', '.join(COLUMNS) + ') VALUES (' +
+										', '.join('?' * len(COLUMNS)) + ')', rows)
+
+	def maybe_flush(self):
+		"Flush if the oldest pending run has waited long enough"
+		if self.pending and cur_time() - self.flushed >= self.interval:
+			self.flush()
+
+	def close(self):
+		self.flush()
+		if self._db:
+			self._db.close()
+			self._db = None
+
+	def jobs(self, pattern=''):
+		"Return the names of jobs containing pattern (* for all)"
+		if pattern in ('', '*'):
+			rows = self.db.execute('SELECT DISTINCT job FROM runs')
+		else:
+			rows = self.db.execute("SELECT DISTINCT job FROM runs WHERE job LIKE ? ESCAPE '\\'",
+								   ('%' + escape_like(pattern) + '%',))
+		return [row[0] for row in rows]
+
+	def percentile(self, job, count, pct):
+		"Return the duration that pct percent of the count runs of job finished within (nearest rank)"
+		rank = max(0, min(count - 1, -(-count * pct // 100) - 1))
+		row = self.db.execute('SELECT duration FROM runs WHERE job = ? ORDER BY duration LIMIT 1 OFFSET ?',
+							  (job, rank)).fetchone()
+		return row[0] if row else None
+
+	def stats(self, job):
+		'''Return dict of run count, failures, failure rate, last run, percentile durations and the longest run.
+		cpu and max_rss are the CPU seconds and peak memory of the last run that recorded them'''
+		count, failures, longest = self.db.execute(
+			'SELECT COUNT(*), SUM(code != 0), MAX(duration) FROM runs WHERE job = ?', (job,)).fetchone()
+		if not count:
+			return None
+		last = self.db.execute('SELECT MAX(start) FROM runs WHERE job = ?', (job,)).fetchone()[0]
+		cpu, max_rss = self.db.execute('SELECT user_cpu + system_cpu, max_rss FROM runs WHERE job = ? AND '
+									   'max_rss IS NOT NULL ORDER BY start DESC LIMIT 1', (job,)).fetchone() or (None, None)
+		out = dict(job=job, runs=count, failures=failures or 0, failure_rate=(failures or 0) / count, last=last,
+				   longest=longest, cpu=cpu, max_rss=max_rss)
+		for pct in PERCENTILES:
+			out['p' + str(pct)] = self.percentile(job, count, pct)
+		return out
+
+	def last_run(self, job):
+		"Return the most recent run of job as a dict, or None"
+		cur = self.db.execute('SELECT * FROM runs WHERE job = ? ORDER BY start DESC LIMIT 1', (job,))
+		row = cur.fetchone()
+		if not row:
+			return None
+		return dict(zip([col[0] for col in cur.description], row))
+
+
+def escape_like(text):
+	return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def print_history(history, pattern=''):
+	"Print the stats for every job matching pattern"
+	timer = time.perf_counter()
+	jobs = sorted(history.jobs(pattern))
+	if not jobs:
+		print("No runs recorded for", repr(pattern) if pattern not in ('', '*') else 'any app', "in", history.filename)
+		return False
+	heads = ['Name', 'Runs', 'Failed'] + ['p' + str(pct) for pct in PERCENTILES] + ['Longest', 'Last run', 'CPU', 'Max RSS']
+	rows = [heads]
+	for job in jobs:
+		stats = history.stats(job)
+		row = [job[:40], str(stats['runs']), '{:.1%}'.format(stats['failure_rate'])]
+		row += [fmt_time(stats['p' + str(pct)]) for pct in PERCENTILES] + [fmt_time(stats['longest'])]
+		row.append(local_time(stats['last'], '%Y-%m-%d %I:%M %p'))
+		if stats['max_rss'] is None:
+			row += ['-', '-']
+		else:
+			row += [fmt_time(stats['cpu']), fmt_bytes(stats['max_rss'])]
+		rows.append(row)
+	widths = [max(len(row[col]) for row in rows) for col in range(len(heads))]
+	for row in rows:
+		print('  '.join(item.ljust(width) for item, width in zip(row, widths)).rstrip())
+	print('\nLooked up', len(jobs), 'apps in', fmt_time(time.perf_counter() - timer))
+	return True
+
+
+def main(args):
+	if not os.path.exists(HISTORY_FILE):
+		print("No history saved yet in", HISTORY_FILE)
+		sys.exit(1)
+	history = RunHistory(HISTORY_FILE, readonly=True)
+	if not print_history(history, args.history):
+		sys.exit(1)
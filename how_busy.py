@@ -1,90 +1,339 @@
 #!/usr/bin/python3
 # Tell me how busy the device running the directory is.
-# Requires: sudo apt-get install sysstat
 # Exit 0 if device not busy
 # Usage ./how_busy folder_name
 
-import re
 import os
 import sys
 import time
+import fnmatch
 import itertools
+from collections import namedtuple
 
-from sd.common import avg, qrun, sorted_array, auto_cols, flatten, check_install
-from sd.common import percent, list_get
-
-def is_device_busy(dev, wait=2, reps=4, verbose=0):
-	"Check how busy the device is"
-	if reps < 2:
-		reps = 2
-
-	usage = []
-	get_ready = False     #next line contains the percentage
-	for line in qrun('nice', 'iostat', '-d', '-x', dev, wait, reps + 1, verbose=verbose):
-		val = re.split(' +', line)[-1]
-		if get_ready:
-			usage.append(float(val))
-		get_ready = bool(val == '%util')
-	# print(dev+':', usage[1:], '=', percent(avg(usage[1:])))
-	return avg(usage[1:])
-
-
-def all_disk_usage(wait=5, reps=4, verbose=0, ignore_links=True):
-	'''Return total i/o for all devices in MB/s
-	ignore_links will ignore loop and dm-? devs for total'''
-
-	ready = False
-	total = 0
-	table = dict()
-	rep = -1
-	for line in qrun('nice', 'iostat', '-d', wait, reps + 1, verbose=verbose):
-		if verbose >= 2:
-			print(rep, line)
-		if not line:
-			continue
-		if line.startswith('Device'):
-			ready = True
-			rep += 1
-			continue
-		if ready and rep > 0:
-			# Skip the first rep because it contains bad data
-			line = line.split()
-			dev = line[0]
-			usage = sum(map(float, line[2:4])) / 1e3
-			table.setdefault(dev, []).append(usage)
-			if ignore_links and (dev.startswith('dm-') or dev.startswith('loop')):
+from sd.common import auto_cols
+from sd.common import percent, list_get, read_state
+
+# Rates are in powers of 1024, the same as sizes from convert_user_size, so limits like 5MB/s compare exactly
+KB = 1024
+MB = 1024 ** 2
+
+DiskUsage = namedtuple('DiskUsage', 'read write util')
+'''
+read  = Bytes read per second
+write = Bytes written per second
+util  = Fraction of the time the device was busy (0 to 1), same as %util in iostat
+'''
+
+
+class DiskStats:
+	'''Read /proc/diskstats without starting a process.
+	The file is opened once and read again from the start each time, so a sample is one read() call.'''
+
+	SECTOR = 512            # Sectors in /proc/diskstats are always 512 bytes
+
+	def __init__(self, filename='/proc/diskstats'):
+		self.fd = os.open(filename, os.O_RDONLY)
+		self.partitions = dict()        # Device name to True if it's a partition
+
+	def close(self):
+		os.close(self.fd)
+
+	def is_partition(self, dev):
+		if dev not in self.partitions:
+			self.partitions[dev] = os.path.exists(os.path.join('/sys/class/block', dev.replace('/', '!'), 'partition'))
+		return self.partitions[dev]
+
+	def counted(self, dev):
+		"Is dev a whole disk? Partitions are already counted in their disk, and dm- and loop devices in the disks below"
+		return not (dev.startswith('dm-') or dev.startswith('loop') or self.is_partition(dev))
+
+	def snapshot(self):
+		"Return (monotonic time, dict of device name to (sectors read, sectors written, milliseconds busy))"
+		data = os.pread(self.fd, 1 << 20, 0)
+		when = time.monotonic()
+		out = dict()
+		for line in data.split(b'\n'):
+			fields = line.split()
+			if len(fields) >= 13:
+				out[fields[2].decode()] = (int(fields[5]), int(fields[9]), int(fields[12]))
+		return when, out
+
+	def usage(self, old, new, devices=None):
+		'''Return dict of device name to DiskUsage between two snapshots.
+		devices = Names to include. Default is every whole disk'''
+		seconds = max(new[0] - old[0], 1e-9)
+		out = dict()
+		for dev, (reads, writes, busy) in new[1].items():
+			if devices is None and not self.counted(dev):
+				continue
+			if devices is not None and dev not in devices:
+				continue
+			if dev not in old[1]:
+				# Plugged in since the last snapshot
 				continue
-			total += usage
+			old_reads, old_writes, old_busy = old[1][dev]
+			out[dev] = DiskUsage(read=(reads - old_reads) * self.SECTOR / seconds,
+								 write=(writes - old_writes) * self.SECTOR / seconds,
+								 util=min((busy - old_busy) / 1000 / seconds, 1))
+		return out
+
+	def measure(self, wait=1, devices=None):
+		"Sample over wait seconds and return dict of device name to DiskUsage"
+		old = self.snapshot()
+		time.sleep(wait)
+		return self.usage(old, self.snapshot(), devices)
+
+
+DISKSTATS = None
+
+
+def get_diskstats():
+	"Return the shared DiskStats, opening /proc/diskstats the first time"
+	global DISKSTATS		# pylint: disable=global-statement
+	if not DISKSTATS:
+		DISKSTATS = DiskStats()
+	return DISKSTATS
+
+
+def print_disk_usage(table):
+	out = [['Device', 'Read MB/s', 'Write MB/s', 'Util']]
+	for dev, usage in sorted(table.items(), key=lambda item: item[1].read + item[1].write, reverse=True):
+		out.append([dev, round(usage.read / MB, 2), round(usage.write / MB, 2), percent(usage.util)])
+	auto_cols(out)
+
+
+def total_mbps(table):
+	"Add up the reads and writes of every device in MB/s"
+	return sum(usage.read + usage.write for usage in table.values()) / MB
+
+
+def is_device_busy(dev, wait=2, verbose=0):
+	"Return the fraction of the time (0 to 1) the device was busy over wait seconds"
+	dev = os.path.basename(os.path.realpath(dev))
+	table = get_diskstats().measure(wait, devices={dev})
 	if verbose:
-		out = [['Device'] + ['Rep ' + str(rep + 1) for rep in range(reps)] + ['', 'Average MB/s']]
-		for dev in sorted(table.keys()):
-			out.append([dev] + list(map(int, table[dev])))
-			out[-1] += ['=', int(avg(table[dev]))]
-		out = [out[0]] + list(sorted_array(out[1:], reverse=True))
-		auto_cols(out, manual={-3: 2, -2: 2})
-	return total / reps
+		print_disk_usage(table)
+	if dev not in table:
+		raise ValueError("Device not found in /proc/diskstats: " + dev)
+	return table[dev].util
+
+
+def all_disk_usage(wait=5, verbose=0):
+	'''Return total i/o for all disks in MB/s over wait seconds.
+	Partitions, loop and dm-? devices are left out so nothing is counted twice.'''
+	table = get_diskstats().measure(wait)
+	if verbose:
+		print_disk_usage(table)
+	return total_mbps(table)
+
+
+NetUsage = namedtuple('NetUsage', 'rx tx')        # Bytes received and sent per second
 
+NET_INCLUDE = ('*',)
+NET_EXCLUDE = ('lo', 'docker*', 'veth*', 'br-*', 'virbr*', 'ifb*')   # Traffic that never leaves the computer or is counted twice
+
+
+class NetStats:
+	'''Read /proc/net/dev without starting a process, like DiskStats.
+	include, exclude = fnmatch patterns for the interface names to count'''
+
+	def __init__(self, filename='/proc/net/dev', include=NET_INCLUDE, exclude=NET_EXCLUDE):
+		self.fd = os.open(filename, os.O_RDONLY)
+		self.include = tuple(include)
+		self.exclude = tuple(exclude)
+		self.matches = dict()           # Interface name to True if it's counted
+
+	def close(self):
+		os.close(self.fd)
+
+	def counted(self, name):
+		if name not in self.matches:
+			self.matches[name] = any(fnmatch.fnmatchcase(name, pat) for pat in self.include) and \
+								 not any(fnmatch.fnmatchcase(name, pat) for pat in self.exclude)
+		return self.matches[name]
+
+	def snapshot(self):
+		"Return (monotonic time, dict of interface name to (bytes received, bytes sent))"
+		data = os.pread(self.fd, 1 << 20, 0)
+		when = time.monotonic()
+		out = dict()
+		# Skip the two header lines
+		for line in data.split(b'\n')[2:]:
+			name, _colon, fields = line.partition(b':')
+			fields = fields.split()
+			if len(fields) >= 9:
+				out[name.strip().decode()] = (int(fields[0]), int(fields[8]))
+		return when, out
+
+	def usage(self, old, new, interfaces=None):
+		'''Return dict of interface name to NetUsage between two snapshots.
+		interfaces = Names to include. Default is every interface matching the patterns'''
+		seconds = max(new[0] - old[0], 1e-9)
+		out = dict()
+		for name, (rx, tx) in new[1].items():
+			if not (self.counted(name) if interfaces is None else name in interfaces):
+				continue
+			if name not in old[1]:
+				continue
+			old_rx, old_tx = old[1][name]
+			# Counters start over if the interface was brought down and up again
+			out[name] = NetUsage(rx=max(rx - old_rx, 0) / seconds, tx=max(tx - old_tx, 0) / seconds)
+		return out
 
-def get_network_usage(interval=1, samples=4, verbose=0):
-	'''Return total network usage in kB/s, adds up rxkB/s and txkB/s columns from sar
-	Requires: sudo apt install sysstat'''
+	def measure(self, wait=1, interfaces=None):
+		"Sample over wait seconds and return dict of interface name to NetUsage"
+		old = self.snapshot()
+		time.sleep(wait)
+		return self.usage(old, self.snapshot(), interfaces)
 
-	out = qrun('sar', '-n', 'DEV', interval, samples, verbose=verbose)
+
+NETSTATS = None
+
+
+def configure_network(include=None, exclude=None):
+	"Set the interface patterns used by get_network_usage. Takes lists or comma seperated text"
+	global NET_INCLUDE, NET_EXCLUDE, NETSTATS		# pylint: disable=global-statement
+	split = lambda pats: tuple(filter(None, (pat.strip() for pat in pats.split(',')))) if isinstance(pats, str) \
+						 else tuple(pats)
+	if include is not None:
+		NET_INCLUDE = split(include)
+	if exclude is not None:
+		NET_EXCLUDE = split(exclude)
+	NETSTATS = None
+
+
+def get_netstats():
+	"Return the shared NetStats, opening /proc/net/dev the first time"
+	global NETSTATS		# pylint: disable=global-statement
+	if not NETSTATS:
+		NETSTATS = NetStats(include=NET_INCLUDE, exclude=NET_EXCLUDE)
+	return NETSTATS
+
+
+def total_kbps(table):
+	"Add up the traffic in and out of every interface in KB/s"
+	return sum(usage.rx + usage.tx for usage in table.values()) / KB
+
+
+def print_net_usage(table):
+	out = [['Interface', 'Received KB/s', 'Sent KB/s']]
+	for name, usage in sorted(table.items(), key=lambda item: item[1].rx + item[1].tx, reverse=True):
+		out.append([name, round(usage.rx / KB, 1), round(usage.tx / KB, 1)])
+	auto_cols(out)
+
+
+def get_network_usage(wait=5, verbose=0):
+	'''Return total network usage in KB/s over wait seconds.
+	Only interfaces matching NET_INCLUDE and not NET_EXCLUDE are counted'''
+	table = get_netstats().measure(wait)
 	if verbose:
-		auto_cols(map(str.split, out[-3:]))
-	out = [line for line in out if line.startswith('Average:')]
-	out = flatten([line.split()[4:6] for line in out[1:]])
-	return int(sum(map(float, out)))
+		print_net_usage(table)
+	return total_kbps(table)
+
+
+class CpuStats:
+	"Read the CPU time counters in /proc/stat, like DiskStats"
+
+	def __init__(self, filename='/proc/stat'):
+		self.fd = os.open(filename, os.O_RDONLY)
+
+	def close(self):
+		os.close(self.fd)
+
+	def snapshot(self):
+		"Return (monotonic time, (busy ticks, total ticks)) added up over every CPU"
+		data = os.pread(self.fd, 4096, 0)
+		when = time.monotonic()
+		# First line: cpu user nice system idle iowait irq softirq steal guest guest_nice
+		fields = [int(num) for num in data.split(b'\n', 1)[0].split()[1:9]]
+		total = sum(fields)
+		return when, (total - fields[3] - fields[4], total)
+
+	@staticmethod
+	def usage(old, new):
+		"Fraction of the CPU time (0 to 1) spent busy between two snapshots"
+		busy = new[1][0] - old[1][0]
+		total = new[1][1] - old[1][1]
+		return busy / total if total > 0 else 0
+
+
+def load_average():
+	"The 1 minute load average"
+	return float(read_state('/proc/loadavg').split()[0])
+
+
+def mem_available():
+	"Bytes of memory available for new programs without swapping (MemAvailable)"
+	for line in read_state('/proc/meminfo', multiline=True):
+		if line.startswith('MemAvailable:'):
+			return int(line.split()[1]) * 1024
+	return None
+
+
+PRESSURE_TYPES = ('cpu', 'io', 'memory')
+
+
+def pressure(kind):
+	'''Percent of the last 10 seconds that some tasks were stalled waiting on kind (cpu, io or memory).
+	Returns None if the kernel doesn't have pressure stall information'''
+	try:
+		line = read_state('/proc/pressure/' + kind)
+	except ValueError:
+		return None
+	for field in line.split():
+		if field.startswith('avg10='):
+			return float(field[6:])
+	return None
+
+
+def snapshot_all():
+	"Snapshot the network and the disks at the same time, for usage_since"
+	return get_netstats().snapshot(), get_diskstats().snapshot()
+
+
+def usage_since(snapshots):
+	"Return (network usage in KB/s, disk usage in MB/s) since snapshot_all()"
+	net_old, disk_old = snapshots
+	net, disk = get_netstats(), get_diskstats()
+	return total_kbps(net.usage(net_old, net.snapshot())), total_mbps(disk.usage(disk_old, disk.snapshot()))
+
+
+DEVICE_NAMES = dict()           # Device number to block device name, for block_device
+
+
+def block_device(path):
+	'''Return the name of the block device (as in /proc/diskstats) that path is stored on, or None.
+	The device number from stat() is looked up in /sys/dev/block instead of running df. Filesystems like btrfs
+	give their files a virtual device number, so for those the source device comes from the mount table.'''
+	try:
+		dev = os.stat(path).st_dev
+	except OSError:
+		return None
+	number = str(os.major(dev)) + ':' + str(os.minor(dev))
+	if number not in DEVICE_NAMES:
+		link = os.path.join('/sys/dev/block', number)
+		if os.path.exists(link):
+			DEVICE_NAMES[number] = os.path.basename(os.path.realpath(link))
+		else:
+			DEVICE_NAMES[number] = None
+			with open('/proc/self/mountinfo') as f:
+				for line in f:
+					fields = line.split()
+					if fields[2] == number and '-' in fields:
+						source = fields[fields.index('-') + 2]
+						if source.startswith('/dev/'):
+							DEVICE_NAMES[number] = os.path.basename(os.path.realpath(source))
+							break
+	return DEVICE_NAMES[number]
 
 
 def find_device(folder):
 	"Given a directory, find the device"
-	if os.path.isdir(folder):
-		return qrun(['df', folder])[1].split()[0]
-	return None
+	name = block_device(folder)
+	return '/dev/' + name if name else None
 
 
-def wait_until_not_busy(folder, threshold=11, wait=2, reps=8, delta=2, sleep=2):
+def wait_until_not_busy(folder, threshold=11, wait=2, delta=2, sleep=2):
 	'''Threshold in % points
 	Loop waiting until device isn't busy.
 	every loop the threshold grows higher by delta'''
@@ -93,7 +342,7 @@ def wait_until_not_busy(folder, threshold=11, wait=2, reps=8, delta=2, sleep=2):
 	print("Probing", dev)
 
 	for x in itertools.count():
-		usage = is_device_busy(dev, wait, reps)
+		usage = is_device_busy(dev, wait)
 		if usage * 100 < threshold:
 			break
 		else:
@@ -105,5 +354,4 @@ def wait_until_not_busy(folder, threshold=11, wait=2, reps=8, delta=2, sleep=2):
 
 
 if __name__ == "__main__":
-	check_install('iostat', msg='sudo apt-get install sysstat')
 	wait_until_not_busy(list_get(sys.argv, 1, '/home'))
@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+# Ways of finding out how long it's been since the user touched the keyboard or mouse.
+# Each source is opened once and then queried without forking a new process.
+# Usage: ./idle_time.py <source> to test a source
+
+import os
+import sys
+import abc
+import glob
+import time
+import select
+import shutil
+import struct
+import ctypes
+import ctypes.util
+
+from sd.common import shell, list_get, sig
+
+
+class IdleSource(abc.ABC):
+	"Base class. query() returns the number of seconds since the last user input"
+	name = None
+
+	@abc.abstractmethod
+	def query(self):
+		"Seconds since the last user input"
+
+	def close(self):
+		pass
+
+
+class _XScreenSaverInfo(ctypes.Structure):
+	_fields_ = [('window', ctypes.c_ulong),
+				('state', ctypes.c_int),
+				('kind', ctypes.c_int),
+				('til_or_since', ctypes.c_ulong),
+				('idle', ctypes.c_ulong),
+				('eventMask', ctypes.c_ulong)]
+
+
+class X11Idle(IdleSource):
+	"Ask the X server directly with the MIT-SCREEN-SAVER extension (what xprintidle does)"
+	name = 'x11'
+
+	def __init__(self):
+		xlib = ctypes.util.find_library('X11')
+		xss = ctypes.util.find_library('Xss')
+		if not xlib or not xss:
+			raise ValueError("Requires libX11 and libXss: sudo apt install libxss1")
+		self.xlib = ctypes.CDLL(xlib)
+		self.xss = ctypes.CDLL(xss)
+		self.xlib.XOpenDisplay.restype = ctypes.c_void_p
+		self.xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+		self.xlib.XDefaultRootWindow.restype = ctypes.c_ulong
+		self.xlib.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+		self.xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+		self.xss.XScreenSaverQueryExtension.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+		self.xss.XScreenSaverAllocInfo.restype = ctypes.POINTER(_XScreenSaverInfo)
+		self.xss.XScreenSaverQueryInfo.argtypes = \
+			[ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(_XScreenSaverInfo)]
+
+		self.display = self.xlib.XOpenDisplay(None)
+		if not self.display:
+			raise ValueError("Cannot open X display: " + os.environ.get('DISPLAY', '$DISPLAY not set'))
+		event, error = ctypes.c_int(), ctypes.c_int()
+		if not self.xss.XScreenSaverQueryExtension(self.display, ctypes.byref(event), ctypes.byref(error)):
+			self.close()
+			raise ValueError("X server does not support the MIT-SCREEN-SAVER extension")
+		self.root = self.xlib.XDefaultRootWindow(self.display)
+		self.info = self.xss.XScreenSaverAllocInfo()
+
+	def query(self):
+		self.xss.XScreenSaverQueryInfo(self.display, self.root, self.info)
+		return self.info.contents.idle / 1000
+
+	def close(self):
+		if self.display:
+			self.xlib.XCloseDisplay(self.display)
+			self.display = None
+
+
+class LogindIdle(IdleSource):
+	'''Read the IdleSinceHint property from systemd-logind.
+	Works on Wayland, but it only changes after the desktop's own idle timeout.
+	Requires: sudo apt install python3-dbus'''
+	name = 'logind'
+
+	def __init__(self):
+		try:
+			import dbus             # pylint: disable=import-outside-toplevel
+		except ImportError:
+			raise ValueError("Requires dbus-python: sudo apt install python3-dbus")
+		try:
+			bus = dbus.SystemBus()
+			obj = bus.get_object('org.freedesktop.login1', '/org/freedesktop/login1')
+		except dbus.exceptions.DBusException as err:
+			raise ValueError("Cannot connect to logind: " + str(err))
+		self.props = dbus.Interface(obj, 'org.freedesktop.DBus.Properties')
+		self.query()
+
+	def query(self):
+		props = self.props.GetAll('org.freedesktop.login1.Manager')
+		if not props['IdleHint']:
+			return 0
+		# Microseconds since the epoch
+		return max(time.time() - props['IdleSinceHint'] / 1e6, 0)
+
+
+class InputIdle(IdleSource):
+	'''Watch the kernel input devices for key presses and mouse movements.
+	Needs read access to /dev/input/event* (root or the input group)'''
+	name = 'input'
+
+	EVENT = struct.Struct('llHHi')      # struct input_event: timeval, type, code, value
+	USER_EVENTS = (1, 2, 3)             # EV_KEY, EV_REL, EV_ABS. Ignores switches like the lid
+
+	def __init__(self, pattern='/dev/input/event*'):
+		self.fds = []
+		for name in sorted(glob.glob(pattern)):
+			try:
+				self.fds.append(os.open(name, os.O_RDONLY | os.O_NONBLOCK | os.O_CLOEXEC))
+			except OSError:
+				continue
+		if not self.fds:
+			raise ValueError("Cannot read any devices in " + pattern + " Try adding yourself to the input group.")
+		self.last = time.time()     # Nothing known before opening, so assume activity then
+
+	def query(self):
+		while True:
+			ready = select.select(self.fds, [], [], 0)[0]
+			if not ready:
+				break
+			for fd in ready:
+				try:
+					data = os.read(fd, self.EVENT.size * 64)
+				except BlockingIOError:
+					continue
+				except OSError:
+					# Unplugged devices start returning errors
+					self.fds.remove(fd)
+					os.close(fd)
+					continue
+				data = data[:len(data) - len(data) % self.EVENT.size]
+				for sec, usec, typ, _code, _val in self.EVENT.iter_unpack(data):
+					if typ in self.USER_EVENTS:
+						self.last = max(self.last, sec + usec / 1e6)
+		return max(time.time() - self.last, 0)
+
+	def close(self):
+		for fd in self.fds:
+			os.close(fd)
+		self.fds = []
+
+
+class XprintidleIdle(IdleSource):
+	"Old method. Runs xprintidle every time"
+	name = 'xprintidle'
+
+	def __init__(self):
+		if not shutil.which('xprintidle'):
+			raise ValueError("xprintidle is not installed: sudo apt install xprintidle")
+
+	def query(self):
+		return float(shell('xprintidle')) / 1000
+
+
+class FakeIdle(IdleSource):
+	'''Pretend idle source for testing
+	Call active() to simulate user input or set() to jump to a given idle time'''
+	name = 'fake'
+
+	def __init__(self, idle=0, clock=time.time):
+		self.clock = clock
+		self.last = clock() - idle
+
+	def active(self):
+		self.last = self.clock()
+
+	def set(self, idle):
+		self.last = self.clock() - idle
+
+	def query(self):
+		return max(self.clock() - self.last, 0)
+
+
+SOURCES = dict(x11=X11Idle, logind=LogindIdle, input=InputIdle, xprintidle=XprintidleIdle, fake=FakeIdle)
+AUTO_ORDER = 'x11 logind input xprintidle'.split()
+
+
+def measure(source, reps=20):
+	"Return the median number of seconds a query takes"
+	times = []
+	for _ in range(reps):
+		start = time.perf_counter()
+		source.query()
+		times.append(time.perf_counter() - start)
+	return sorted(times)[len(times) // 2]
+
+
+def open_source(name='auto', verbose=1):
+	"Open the requested idle source, or the first one that works with auto"
+	if name == 'auto':
+		names = AUTO_ORDER
+	elif name in SOURCES:
+		names = [name]
+	else:
+		raise ValueError("Unknown idle source: " + name + " Choose from: auto, " + ', '.join(SOURCES))
+
+	errors = []
+	for sname in names:
+		try:
+			source = SOURCES[sname]()
+		except ValueError as err:
+			errors.append(sname + ': ' + str(err))
+			continue
+		if verbose:
+			for line in errors:
+				print("Idle source unavailable:", line)
+			print("Using idle source:", source.name, 'at', sig(measure(source) * 1e6), 'microseconds per check')
+		return source
+	for line in errors:
+		print("Idle source unavailable:", line)
+	raise ValueError("Could not find a way to read the idle time")
+
+
+if __name__ == "__main__":
+	SOURCE = open_source(list_get(sys.argv, 1, 'auto'))
+	while True:
+		print(SOURCE.name, 'idle for', SOURCE.query(), 'seconds')
+		time.sleep(1)
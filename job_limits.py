@@ -0,0 +1,242 @@
+#!/usr/bin/python3
+# Start jobs with a lower priority and hard limits: nice, ionice, CPU affinity, rlimits and cgroup v2 settings.
+# Set in the optional limits column of schedule.txt, like: nice 10, ionice idle, cpus 0-1, as 2G
+
+import os
+import shutil
+import resource
+
+from sd.common import convert_user_size, safe_filename
+from sd.chronology import convert_user_time
+
+'''
+The limits are set by the standard tools, chained in front of the job's shell: nice, ionice, taskset and prlimit,
+plus a small sh wrapper that joins the job's cgroup. Each one sets its limit on itself and then execs the next,
+so the limits cover the shell and everything it starts while the daemon keeps its own priority.
+No Python runs between fork and exec, which isn't safe in a daemon with threads.
+If a limit can't be set, a note is printed (or written to the job's error log) and the job runs without it.
+
+Available limits:
+	nice 10                 Add to the niceness (default 10)
+	ionice idle             I/O class: idle (the default), best-effort or realtime, with an optional level 0-7
+	cpus 0-3 6              CPUs the job may run on, as numbers and ranges or a hex mask like 0xf
+	as 2G                   RLIMIT_AS: Most virtual memory each process can use (default unit MB)
+	cpu 1h                  RLIMIT_CPU: Most CPU time each process can use
+	nofile 1024             RLIMIT_NOFILE: Most open files for each process
+	cpu.weight 50           cgroup v2 settings for the whole job, see below
+	io.weight 10
+	memory.max 2G
+'''
+
+IOPRIO_CLASSES = {'realtime': 1, 'rt': 1, 'best-effort': 2, 'be': 2, 'idle': 3}
+IOPRIO_IDLE = 3
+
+RLIMITS = {'as': resource.RLIMIT_AS, 'cpu': resource.RLIMIT_CPU, 'nofile': resource.RLIMIT_NOFILE}
+
+# cgroup settings and the values they go back to when a job stops asking for them
+CGROUP_DEFAULTS = {'cpu.weight': '100', 'io.weight': 'default 100', 'memory.max': 'max'}
+
+
+def parse_cpus(words):
+	"Turn cpu numbers and ranges like 0-3 6, or a hex mask like 0xf, into a set of cpu numbers"
+	cpus = set()
+	for word in words:
+		if word.startswith('0x'):
+			mask = int(word, 16)
+			cpus.update(num for num in range(mask.bit_length()) if mask >> num & 1)
+		elif '-' in word:
+			first, last = map(int, word.split('-'))
+			cpus.update(range(first, last + 1))
+		else:
+			cpus.add(int(word))
+	if not cpus:
+		raise ValueError("No cpus given")
+	return cpus
+
+
+def parse(text, limits):
+	"Read one item of the limits column, like: nice 10, into the dict limits. Raises ValueError if it can't"
+	words = text.lower().split()
+	if not words:
+		raise ValueError("Empty limit")
+	name, values = words[0], words[1:]
+	try:
+		if name == 'nice':
+			limits['nice'] = int(values[0]) if values else 10
+		elif name == 'ionice':
+			cls = IOPRIO_CLASSES[values[0]] if values else IOPRIO_CLASSES['idle']
+			level = int(values[1]) if len(values) > 1 else 4
+			if not 0 <= level <= 7:
+				raise ValueError("ionice level must be 0-7")
+			limits['ionice'] = (cls, level)
+		elif name == 'cpus':
+			limits['cpus'] = parse_cpus(values)
+		elif name == 'as':
+			limits['as'] = convert_user_size(values[0], default='mb')
+		elif name == 'cpu':
+			limits['cpu'] = int(convert_user_time(' '.join(values)))
+		elif name == 'nofile':
+			limits['nofile'] = int(values[0])
+		elif name == 'memory.max':
+			limits.setdefault('cgroup', {})[name] = convert_user_size(values[0], default='mb')
+		elif name in CGROUP_DEFAULTS:
+			weight = int(values[0])
+			if not 1 <= weight <= 10000:
+				raise ValueError(name + " must be 1-10000")
+			limits.setdefault('cgroup', {})[name] = weight
+		else:
+			raise ValueError("Unknown limit: " + name)
+	except (IndexError, KeyError):
+		raise ValueError("Can't read limit: " + text) from None
+	return limits
+
+
+# Write the shell's own pid into the cgroup.procs file given as $0, then become the job
+CGROUP_WRAPPER = 'echo $$ > "$0" || echo "LazyCron could not join cgroup" >&2; exec "$@"'
+
+
+TOOLS = dict()                      # Name to path, or None if it's missing
+
+
+def find_tool(name):
+	"Return the path of a limit setting tool, printing a note the first time it can't be found"
+	if name not in TOOLS:
+		TOOLS[name] = shutil.which(name)
+		if not TOOLS[name]:
+			print("Ignoring limits that need", name + ": It isn't installed")
+	return TOOLS[name]
+
+
+def soft_limit(kind, value):
+	"Keep a soft limit under the hard limit the job will inherit, so it can't be refused for asking too much"
+	_soft, hard = resource.getrlimit(kind)
+	return value if hard == resource.RLIM_INFINITY else min(value, hard)
+
+
+def read_file(filename):
+	with open(filename) as f:
+		return f.read().strip()
+
+
+def write_file(filename, text):
+	with open(filename, 'w') as f:
+		f.write(text)
+
+
+class Cgroups:
+	'''Give each job its own cgroup v2 with the cpu.weight, io.weight and memory.max settings it asks for.
+	Only used when the daemon runs in a cgroup it's allowed to manage, like a systemd user service
+	with Delegate=yes. cgroup v2 won't enable controllers for children of a cgroup that has processes in it,
+	so the first time it's needed the daemon moves itself into a daemon/ leaf and each job gets job-<name>/.'''
+
+	def __init__(self):
+		self.base = None                # The delegated cgroup directory
+		self.ready = None               # None until setup() has been tried
+
+	@staticmethod
+	def find():
+		"Return the directory of the daemon's cgroup if it can be managed, else None"
+		root = None
+		with open('/proc/self/mountinfo') as f:
+			for line in f:
+				fields = line.split()
+				if '-' in fields and fields[fields.index('-') + 1] == 'cgroup2':
+					root = fields[4]
+					break
+		if not root:
+			return None
+		with open('/proc/self/cgroup') as f:
+			path = [line[3:].strip() for line in f if line.startswith('0::')]
+		if not path or path[0] == '/':
+			# Never manage the root cgroup
+			return None
+		base = os.path.join(root, path[0].lstrip('/'))
+		if os.path.basename(base) == 'daemon':
+			# Already moved in by an earlier setup
+			base = os.path.dirname(base)
+		if os.access(base, os.W_OK) and os.access(os.path.join(base, 'cgroup.subtree_control'), os.W_OK):
+			return base
+		return None
+
+	def setup(self):
+		"Move the daemon into its leaf and enable the controllers. Returns True if job cgroups can be made"
+		if self.ready is not None:
+			return self.ready
+		self.ready = False
+		base = self.find()
+		if not base:
+			print("Ignoring cgroup limits: LazyCron isn't running in a cgroup it can manage (try Delegate=yes)")
+			return False
+		try:
+			leaf = os.path.join(base, 'daemon')
+			os.makedirs(leaf, exist_ok=True)
+			write_file(os.path.join(leaf, 'cgroup.procs'), str(os.getpid()))
+			available = read_file(os.path.join(base, 'cgroup.controllers')).split()
+			wanted = [name for name in ('cpu', 'io', 'memory') if name in available]
+			if wanted:
+				write_file(os.path.join(base, 'cgroup.subtree_control'), ' '.join('+' + name for name in wanted))
+		except OSError as err:
+			print("Ignoring cgroup limits: Could not set up", base + ':', err)
+			return False
+		print("Starting jobs with cgroup limits in", base)
+		self.base = base
+		self.ready = True
+		return True
+
+	def prepare(self, name, settings):
+		"Make the cgroup for a job and write its settings. Returns the path of its cgroup.procs or None"
+		if not self.setup():
+			return None
+		path = os.path.join(self.base, 'job-' + safe_filename(name))
+		try:
+			os.makedirs(path, exist_ok=True)
+		except OSError as err:
+			print("Could not make cgroup", path + ':', err)
+			return None
+		for key, default in CGROUP_DEFAULTS.items():
+			try:
+				write_file(os.path.join(path, key), str(settings.get(key, default)))
+			except OSError as err:
+				if key in settings:
+					print("Could not set", key, "for", name + ':', err)
+		return os.path.join(path, 'cgroup.procs')
+
+
+CGROUPS = Cgroups()
+
+
+def prefix(limits, name):
+	'''Return the argv of tools to run in front of the job's shell to apply limits.
+	name = Job name for its cgroup'''
+	args = []
+	if not limits:
+		return args
+	if 'nice' in limits and find_tool('nice'):
+		args += [TOOLS['nice'], '-n', str(limits['nice'])]
+	if 'ionice' in limits and find_tool('ionice'):
+		cls, level = limits['ionice']
+		# -t runs the job anyway when the class isn't allowed, like realtime without root
+		args += [TOOLS['ionice'], '-t', '-c', str(cls)]
+		if cls != IOPRIO_IDLE:
+			args += ['-n', str(level)]
+	if 'cpus' in limits and find_tool('taskset'):
+		cpus = limits['cpus'] & os.sched_getaffinity(0)
+		if cpus:
+			args += [TOOLS['taskset'], '-c', ','.join(map(str, sorted(cpus)))]
+		else:
+			print("Ignoring cpus for", name + ": None of them are available")
+	rlimits = [key for key in RLIMITS if key in limits]
+	if rlimits and find_tool('prlimit'):
+		args.append(TOOLS['prlimit'])
+		# value: with no hard limit after the colon only sets the soft limit
+		args += ['--' + key + '=' + str(soft_limit(RLIMITS[key], limits[key])) + ':' for key in rlimits]
+	if limits.get('cgroup'):
+		procs = CGROUPS.prepare(name, limits['cgroup'])
+		if procs:
+			args += ['/bin/sh', '-c', CGROUP_WRAPPER, procs]
+	return args
+
+
+def command(cmd, limits, name):
+	"Return the argv for Popen that runs the shell command cmd with limits applied"
+	return prefix(limits, name) + ['/bin/sh', '-c', cmd]
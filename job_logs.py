@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+# Stream the output of jobs into rolling log files, one set for each job.
+# Closed log files are compressed in the background and old ones are deleted.
+
+import os
+import re
+import glob
+import gzip
+import queue
+import shutil
+import asyncio
+import threading
+
+import accounting
+from sd.common import spawn
+from sd.chronology import local_time, cur_time
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+
+'''
+For a job logging to logs/backup.sh:
+	logs/backup.sh.log                              stdout of the latest runs
+	logs/backup.sh.err                              stderr of the latest runs
+	logs/backup.sh.20240101-120000.log.zst          Older output, compressed
+'''
+
+CHUNK = 65536               # Bytes read from a job's pipe at a time
+LIMITS = dict(
+	run=10 * 1024**2,       # Bytes of stdout or stderr saved from one run. The rest is thrown away
+	job=50 * 1024**2,       # Bytes of logs kept on disk for each job, not counting the current files
+	keep=10,                # Number of old log files kept for each job
+	)
+
+
+def configure(run=None, job=None, keep=None):
+	"Set the log limits for every job"
+	for key, val in dict(run=run, job=job, keep=keep).items():
+		if val is not None:
+			LIMITS[key] = val
+
+
+def compressed_name(filename):
+	return filename + ('.zst' if zstandard else '.gz')
+
+
+def compress_file(filename):
+	"Compress a file with zstd if available, otherwise gzip, and delete the original"
+	target = compressed_name(filename)
+	tmp = target + '.tmp'
+	with open(filename, 'rb') as src, open(tmp, 'wb') as dest:
+		if zstandard:
+			zstandard.ZstdCompressor().copy_stream(src, dest)
+		else:
+			with gzip.GzipFile(fileobj=dest, mode='wb') as gz:
+				shutil.copyfileobj(src, gz)
+	os.replace(tmp, target)
+	os.remove(filename)
+	return target
+
+
+class Compressor:
+	"One background thread that compresses closed log files so jobs never wait on it"
+
+	def __init__(self):
+		self.que = queue.Queue()
+		self.thread = None
+
+	def submit(self, filename, callback=None):
+		if not self.thread:
+			_que, self.thread = spawn(self.worker)
+		self.que.put((filename, callback))
+
+	def worker(self):
+		while True:
+			filename, callback = self.que.get()
+			try:
+				compress_file(filename)
+			except OSError as err:
+				print("Could not compress", filename + ':', err)
+			if callback:
+				callback()
+			self.que.task_done()
+
+	def wait(self):
+		"Block until everything submitted has been compressed"
+		self.que.join()
+
+
+COMPRESSOR = Compressor()
+
+
+class JobLog:
+	'''The rolling .log and .err files for one job.
+	When a file gets bigger than its share of LIMITS['job'] it's closed, renamed with the time and compressed.'''
+
+	def __init__(self, base):
+		self.base = base            # Path without the extension, like logs/backup.sh
+		self.lock = threading.Lock()
+		self.files = dict()         # Stream name to open file
+
+	def filename(self, stream):
+		return self.base + '.' + stream
+
+	def segment_size(self):
+		"Size at which the current file is rotated so that keep old files fit in the job limit"
+		return max(LIMITS['job'] // (LIMITS['keep'] + 1), CHUNK)
+
+	def append(self, stream, data):
+		"Write bytes to the current log file for stream (log or err)"
+		with self.lock:
+			file = self.files.get(stream)
+			if not file:
+				file = self.files[stream] = open(self.filename(stream), 'ab')
+			file.write(data)
+			if file.tell() >= self.segment_size():
+				self.rotate(stream)
+
+	def close(self):
+		with self.lock:
+			for file in self.files.values():
+				file.close()
+			self.files.clear()
+
+	def rotate(self, stream):
+		"Close the current file and hand it to the compressor. Called with the lock held"
+		self.files.pop(stream).close()
+		stamp = local_time(user_format='%Y%m%d-%H%M%S')
+		target = self.base + '.' + stamp + '.' + stream
+		count = 1
+		while os.path.exists(target) or os.path.exists(compressed_name(target)):
+			count += 1
+			target = self.base + '.' + stamp + '-' + str(count) + '.' + stream
+		os.rename(self.filename(stream), target)
+		COMPRESSOR.submit(target, callback=lambda: self.prune(stream))
+
+	def old_files(self, stream):
+		"Return the compressed files for stream, oldest first"
+		pattern = glob.escape(self.base) + '.*.' + stream + '.*'
+		match = re.compile(re.escape(self.base) + r'\.(\d{8}-\d{6})(?:-(\d+))?\.' + stream + r'\.(?:zst|gz)$')
+		found = []
+		for name in glob.glob(pattern):
+			parts = match.match(name)
+			if parts:
+				found.append((parts.group(1), int(parts.group(2) or 1), name))
+		return [name for _stamp, _count, name in sorted(found)]
+
+	def prune(self, stream):
+		"Delete the oldest files beyond the keep and size limits"
+		files = self.old_files(stream)
+		sizes = [os.path.getsize(name) for name in files]
+		while files and (len(files) > LIMITS['keep'] or sum(sizes) > LIMITS['job']):
+			os.remove(files.pop(0))
+			sizes.pop(0)
+
+	def start_run(self, cmd):
+		return Run(self, cmd)
+
+
+class Run:
+	"The output of one run of a job. Each stream is capped at LIMITS['run'] bytes"
+
+	def __init__(self, log, cmd):
+		self.log = log
+		self.cmd = cmd
+		self.start_time = cur_time()
+		self.end_time = None
+		self.code = None
+		self.usage = None       # accounting.Usage of the finished run
+		self.started = local_time(self.start_time, user_format='%Y-%m-%d %I:%M:%S %p')
+		self.written = dict(log=0, err=0)       # Bytes saved
+		self.dropped = dict(log=0, err=0)       # Bytes thrown away
+		self.headed = set()                     # Streams that have the header line for this run
+
+	def header(self, stream):
+		"Start this run's section of a stream with the time and command, once"
+		if stream not in self.headed:
+			self.headed.add(stream)
+			self.log.append(stream, ('\n=== ' + self.started + ': ' + self.cmd + '\n').encode())
+
+	def write(self, stream, data):
+		self.header(stream)
+		room = LIMITS['run'] - self.written[stream]
+		if room < len(data):
+			self.dropped[stream] += len(data) - max(room, 0)
+			data = data[:max(room, 0)]
+		if data:
+			self.written[stream] += len(data)
+			self.log.append(stream, data)
+
+	def finish(self, code=0, usage=None):
+		"Note anything that was thrown away, the return code and what the run cost"
+		self.end_time = cur_time()
+		self.code = code
+		self.usage = usage
+		if code:
+			# Not counted against the limit, so it's there even when the output filled it
+			self.header('err')
+			self.log.append('err', ('\n=== Returned code ' + str(code) + '\n').encode())
+		for stream, dropped in self.dropped.items():
+			if dropped:
+				self.log.append(stream, ('\n=== Output over the limit, dropped ' + str(dropped) + ' bytes\n').encode())
+		if usage:
+			# Only goes in the logs that this run wrote to
+			for stream in ('log', 'err'):
+				if stream in self.headed:
+					self.log.append(stream, ('=== ' + accounting.describe(usage) + '\n').encode())
+		self.log.close()
+
+	@property
+	def output_bytes(self):
+		"Bytes of output, including anything that was thrown away"
+		return sum(self.written.values()) + sum(self.dropped.values())
+
+	@property
+	def err_name(self):
+		return self.log.filename('err')
+
+
+LOGS = dict()       # Base path to JobLog
+LOGS_LOCK = threading.Lock()
+
+
+def get_log(base):
+	"Return the JobLog for a base path, shared by every run of that job"
+	with LOGS_LOCK:
+		if base not in LOGS:
+			LOGS[base] = JobLog(base)
+		return LOGS[base]
+
+
+def stream_output(proc, run, buffer=64):
+	'''Read the stdout and stderr of a subprocess.Popen in reader threads and write them to run.
+	The queue between them holds at most buffer chunks, so a job that outruns the disk waits.'''
+	que = queue.Queue(maxsize=buffer)
+
+	def reader(pipe, stream):
+		fd = pipe.fileno()
+		while True:
+			data = os.read(fd, CHUNK)
+			if not data:
+				break
+			que.put((stream, data))
+		pipe.close()
+		que.put((stream, None))
+
+	for pipe, stream in ((proc.stdout, 'log'), (proc.stderr, 'err')):
+		spawn(reader, pipe, stream)
+	open_streams = 2
+	while open_streams:
+		stream, data = que.get()
+		if data is None:
+			open_streams -= 1
+		else:
+			run.write(stream, data)
+
+
+async def stream_output_async(stdout, stderr, run, buffer=64):
+	"Same as stream_output for a pair of asyncio.StreamReaders"
+	que = asyncio.Queue(maxsize=buffer)
+
+	async def reader(pipe, stream):
+		while True:
+			data = await pipe.read(CHUNK)
+			if not data:
+				break
+			await que.put((stream, data))
+		await que.put((stream, None))
+
+	readers = [asyncio.ensure_future(reader(pipe, stream)) for pipe, stream in ((stdout, 'log'), (stderr, 'err'))]
+	open_streams = 2
+	while open_streams:
+		stream, data = await que.get()
+		if data is None:
+			open_streams -= 1
+		else:
+			run.write(stream, data)
+	await asyncio.gather(*readers)
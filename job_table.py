@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+# Check every app in a big schedule at once with NumPy instead of one Scheduler at a time.
+# Requires: pip3 install numpy
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+
+class JobTable:
+	'''Arrays of every app's window, frequency and idle requirements.
+	due() and next_wakeup() work out the whole schedule in one vectorized pass.
+	Only apps whose window has closed go back to Scheduler.calc_window()'''
+
+	def __init__(self, procs):
+		if np is None:
+			raise ValueError("JobTable requires numpy: pip3 install numpy")
+		self.procs = list(procs)
+		self.rows = {proc: row for row, proc in enumerate(self.procs)}
+		size = len(self.procs)
+		self.start = np.zeros(size)
+		self.stop = np.zeros(size)
+		self.next_elapsed = np.zeros(size)
+		self.last_run = np.zeros(size)
+		self.freq = np.zeros(size, dtype=bool)     # Has a frequency, so can run more than once a window
+		self.idle = np.zeros(size)                 # reqs.idle
+		self.busy = np.zeros(size)                 # reqs.busy, 0 = None
+		for row in range(size):
+			self.update_row(row)
+
+	def __len__(self):
+		return len(self.procs)
+
+	def update_row(self, row):
+		proc = self.procs[row]
+		self.start[row] = proc.start
+		self.stop[row] = proc.stop
+		self.next_elapsed[row] = proc.next_elapsed
+		self.last_run[row] = proc.last_run
+		self.freq[row] = bool(proc.freq)
+		self.idle[row] = proc.reqs.idle
+		self.busy[row] = proc.reqs.busy
+
+	def update(self, proc):
+		"Copy the state of a proc that just changed (after running) into the table"
+		self.update_row(self.rows[proc])
+
+	def expire(self, now):
+		"Calculate new windows for apps whose window has closed, like in_window() would"
+		for row in np.nonzero(now > self.stop)[0]:
+			self.procs[row].calc_window()
+			self.update_row(row)
+
+	def in_window(self, now):
+		"Boolean array of apps in their window that haven't already run in it"
+		inside = (self.start <= now) & (now <= self.stop)
+		ran = (self.start <= self.last_run) & (self.last_run <= self.stop)
+		return inside & (self.freq | ~ran)
+
+	def due(self, now, elapsed, idle):
+		'''Yield (proc, blocked) for each app that is due to run.
+		blocked = 'idle' or 'busy' if that requirement isn't met, like Scheduler.blocked, else None
+		Requirements that can't be vectorized (lid, power, random) are left to Scheduler.ready()'''
+		self.expire(now)
+		due = self.in_window(now) & (self.next_elapsed <= elapsed)
+		idle_low = self.idle > idle
+		too_idle = (self.busy != 0) & (idle > self.busy)
+		for row in np.nonzero(due)[0]:
+			yield self.procs[row], 'idle' if idle_low[row] else 'busy' if too_idle[row] else None
+
+	def next_wakeup(self, now, elapsed, idle):
+		"Same as the earliest of Scheduler.wakeups() for every app. Returns (time, proc)"
+		if not self.procs:
+			return float('inf'), None
+		self.expire(now)
+		inside = self.in_window(now)
+		when = self.stop + 1
+		when = np.where(now < self.start, np.minimum(when, self.start), when)
+		waiting = inside & (self.next_elapsed > elapsed)
+		when = np.where(waiting, np.minimum(when, now + self.next_elapsed - elapsed), when)
+		waiting = inside & (self.idle > idle)
+		when = np.where(waiting, np.minimum(when, now + self.idle - idle), when)
+		row = int(np.argmin(when))
+		return float(when[row]), self.procs[row]
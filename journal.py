@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+# Remember when each job ran and how much active time has built up across restarts.
+# Usage: ./journal.py <journal file> to show what's saved
+
+import os
+import sys
+import time
+from collections import deque
+
+from sd.common import DotDict, mkdir, list_get
+from sd.chronology import local_time, fmt_time, cur_time
+
+'''
+Journal format, one tab seperated record per line:
+	R  job_id  unix_time  elapsed       A job ran
+	E  unix_time  elapsed               Active time checkpoint
+	J  job_id  elapsed  time,time...  seen    Compacted job history. seen = last time the job was in the schedule
+
+Editing a schedule line gives it a new job id, so compacting drops jobs that have been out of the schedule
+for more than GRACE seconds. Putting a line back within that time brings back its history.
+'''
+
+GRACE = 30 * 86400
+
+
+class Journal:
+	'''Append only log of runs and active time checkpoints keyed by job id.
+	Once it gets long it's compacted down to one line per job.
+	keep     = Number of run times to keep for each job
+	readonly = Read the journal but never write to it (testing mode)'''
+
+	def __init__(self, filename, keep=32, readonly=False, compact_at=10000, grace=GRACE):
+		self.filename = filename
+		self.keep = keep
+		self.readonly = readonly
+		self.compact_at = compact_at    # Compact when this many extra lines have built up
+		self.grace = grace              # Seconds to keep jobs that are no longer in the schedule
+		self.live = None                # Job ids in the schedule, once it has been read
+		self.jobs = dict()              # job_id to DotDict(history, last_elapsed)
+		self.elapsed = 0                # Last known active time
+		self.saved = 0                  # Time of last record
+		self.lines = 0                  # Lines in file
+		self.file = None
+		if os.path.dirname(filename):
+			mkdir(os.path.dirname(filename))
+
+	def job(self, job_id):
+		"Return the state for a job, creating it if needed"
+		if job_id not in self.jobs:
+			self.jobs[job_id] = DotDict(history=deque(maxlen=self.keep), last_elapsed=0, seen=int(cur_time()))
+		return self.jobs[job_id]
+
+	def replay(self, verbose=1):
+		"Read the journal into memory. Returns dict of job states"
+		start = time.perf_counter()
+		if not os.path.exists(self.filename):
+			return self.jobs
+		with open(self.filename) as f:
+			for line in f:
+				self.lines += 1
+				fields = line.rstrip('\n').split('\t')
+				try:
+					kind = fields[0]
+					if kind == 'R':
+						job = self.job(fields[1])
+						job.history.append(int(fields[2]))
+						job.last_elapsed = self.elapsed = float(fields[3])
+						self.saved = int(fields[2])
+					elif kind == 'E':
+						self.saved = int(fields[1])
+						self.elapsed = float(fields[2])
+					elif kind == 'J':
+						job = self.job(fields[1])
+						job.last_elapsed = float(fields[2])
+						job.history.extend(map(int, filter(None, fields[3].split(','))))
+						# Older journals don't have seen
+						job.seen = int(fields[4]) if len(fields) > 4 else max(job.history, default=self.saved)
+					else:
+						raise ValueError
+				except (ValueError, IndexError):
+					# Probably a line cut off by a crash
+					print("Skipping bad line", self.lines, "in", self.filename + ':', repr(line[:80]))
+		if verbose:
+			print("Replayed", self.lines, "journal lines for", len(self.jobs), "jobs in",
+				  fmt_time(time.perf_counter() - start))
+		if self.lines > self.compact_at + len(self.jobs):
+			self.compact()
+		return self.jobs
+
+	def _write(self, *fields):
+		if self.readonly:
+			return
+		if not self.file:
+			self.file = open(self.filename, 'a')
+		self.file.write('\t'.join(map(str, fields)) + '\n')
+		self.file.flush()
+		self.lines += 1
+		if self.lines > self.compact_at + len(self.jobs):
+			self.compact()
+
+	def record_run(self, job_id, when, elapsed):
+		"Save the time a job ran at"
+		job = self.job(job_id)
+		job.history.append(int(when))
+		job.last_elapsed = self.elapsed = elapsed
+		job.seen = self.saved = int(when)
+		self._write('R', job_id, int(when), round(elapsed, 1))
+
+	def checkpoint(self, elapsed):
+		"Save the active time"
+		self.elapsed = elapsed
+		self.saved = int(cur_time())
+		self._write('E', self.saved, round(elapsed, 1))
+
+	def set_live(self, job_ids):
+		"Tell the journal which jobs are in the schedule now"
+		self.live = set(job_ids)
+		now = int(cur_time())
+		for job_id in self.live:
+			if job_id in self.jobs:
+				self.jobs[job_id].seen = now
+
+	def prune(self):
+		"Forget jobs that have been out of the schedule for longer than grace. Nothing is dropped until set_live()"
+		if self.live is None:
+			return
+		now = cur_time()
+		for job_id in [job_id for job_id, job in self.jobs.items()
+					   if job_id not in self.live and now - job.seen > self.grace]:
+			del self.jobs[job_id]
+
+	def compact(self):
+		"Rewrite the journal with one line per job and then the last checkpoint"
+		if self.readonly:
+			return
+		self.prune()
+		if self.file:
+			self.file.close()
+			self.file = None
+		tmp = self.filename + '.tmp'
+		with open(tmp, 'w') as f:
+			for job_id, job in self.jobs.items():
+				f.write('\t'.join(('J', job_id, str(round(job.last_elapsed, 1)), ','.join(map(str, job.history)),
+									str(job.seen))) + '\n')
+			f.write('\t'.join(('E', str(self.saved), str(round(self.elapsed, 1)))) + '\n')
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp, self.filename)
+		self.lines = len(self.jobs) + 1
+
+
+if __name__ == "__main__":
+	JOURNAL = Journal(list_get(sys.argv, 1, 'state/lazycron.journal'), readonly=True)
+	for JOB_ID, JOB in JOURNAL.replay().items():
+		LAST = JOB.history[-1] if JOB.history else 0
+		print(JOB_ID, 'ran', len(JOB.history), 'times, last:', local_time(LAST, '%Y-%m-%d %I:%M %p') if LAST else 'never')
+	print('Active time:', fmt_time(JOURNAL.elapsed), 'saved at', local_time(JOURNAL.saved, '%Y-%m-%d %I:%M %p'))
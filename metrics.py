@@ -0,0 +1,244 @@
+#!/usr/bin/python3
+# Keep counters of what the daemon is doing in memory and write them out for node_exporter's textfile collector.
+# Usage: ./LazyCron.py --metrics /var/lib/node_exporter/textfile/lazycron.prom
+
+import os
+import math
+import time
+import threading
+
+import battery_watcher
+from sd.chronology import cur_time
+
+'''
+The file is written in the OpenMetrics text format and replaced atomically, so the collector never sees half of it.
+Nothing here starts a subprocess: every number comes from counters updated by the daemon as it goes,
+and the battery is read straight from /sys.
+'''
+
+# Bucket upper bounds in seconds
+FAST_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+JOB_BUCKETS = (0.1, 1, 5, 15, 60, 300, 900, 3600, 4 * 3600, 12 * 3600)
+
+
+def fmt_value(num):
+	if num == math.inf:
+		return '+Inf'
+	if num == -math.inf:
+		return '-Inf'
+	if isinstance(num, float) and num.is_integer() and abs(num) < 1e15:
+		return str(int(num))
+	return repr(num)
+
+
+def fmt_labels(names, values, extra=()):
+	pairs = list(zip(names, values)) + list(extra)
+	if not pairs:
+		return ''
+	escape = lambda text: str(text).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+	return '{' + ','.join(name + '="' + escape(val) + '"' for name, val in pairs) + '}'
+
+
+class Metric:
+	"Base class. Values are kept for each combination of label values"
+	kind = None
+	suffix = ''
+
+	def __init__(self, name, text, labels=(), lock=None):
+		self.name = name
+		self.text = text
+		self.labels = tuple(labels)
+		self.values = dict()            # Tuple of label values to value
+		self.lock = lock or threading.Lock()
+
+	def key(self, labels):
+		if len(labels) != len(self.labels):
+			raise ValueError(self.name + " needs labels: " + ', '.join(self.labels))
+		return tuple(str(val) for val in labels)
+
+	def samples(self):
+		"Yield (name with suffix, label text, value)"
+		for key, val in sorted(self.values.items()):
+			yield self.name + self.suffix, fmt_labels(self.labels, key), val
+
+	def render(self):
+		lines = ['# TYPE ' + self.name + ' ' + self.kind, '# HELP ' + self.name + ' ' + self.text]
+		with self.lock:
+			for name, labels, val in self.samples():
+				lines.append(name + labels + ' ' + fmt_value(val))
+		return lines
+
+
+class Counter(Metric):
+	"A number that only goes up"
+	kind = 'counter'
+	suffix = '_total'
+
+	def inc(self, *labels, amount=1):
+		key = self.key(labels)
+		with self.lock:
+			self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+	"A number that can go up and down"
+	kind = 'gauge'
+
+	def set(self, value, *labels):
+		key = self.key(labels)
+		with self.lock:
+			self.values[key] = value
+
+
+class Histogram(Metric):
+	"Count observations into buckets, along with their sum and count"
+	kind = 'histogram'
+
+	def __init__(self, name, text, labels=(), buckets=FAST_BUCKETS, lock=None):
+		super().__init__(name, text, labels, lock)
+		self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+	def observe(self, value, *labels):
+		key = self.key(labels)
+		with self.lock:
+			counts = self.values.get(key)
+			if not counts:
+				# Counts for each bucket on their own, then the sum
+				counts = self.values[key] = [0] * len(self.buckets) + [0]
+			for index, bound in enumerate(self.buckets):
+				if value <= bound:
+					counts[index] += 1
+					break
+			counts[-1] += value
+
+	def time(self, *labels):
+		"Context manager that observes how long the block took"
+		return Timer(self, labels)
+
+	def samples(self):
+		for key, counts in sorted(self.values.items()):
+			total = 0
+			for bound, count in zip(self.buckets, counts):
+				total += count
+				yield self.name + '_bucket', fmt_labels(self.labels, key, [('le', fmt_value(float(bound)))]), total
+			yield self.name + '_count', fmt_labels(self.labels, key), total
+			yield self.name + '_sum', fmt_labels(self.labels, key), counts[-1]
+
+
+class Timer:
+	def __init__(self, histogram, labels):
+		self.histogram = histogram
+		self.labels = labels
+		self.start = 0
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *_args):
+		self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Registry:
+	"Every metric the daemon keeps, in the order they were made"
+
+	def __init__(self, prefix='lazycron_'):
+		self.prefix = prefix
+		self.metrics = []
+
+	def add(self, cls, name, text, labels=(), **kargs):
+		metric = cls(self.prefix + name, text, labels, **kargs)
+		self.metrics.append(metric)
+		return metric
+
+	def counter(self, name, text, labels=()):
+		return self.add(Counter, name, text, labels)
+
+	def gauge(self, name, text, labels=()):
+		return self.add(Gauge, name, text, labels)
+
+	def histogram(self, name, text, labels=(), buckets=FAST_BUCKETS):
+		return self.add(Histogram, name, text, labels, buckets=buckets)
+
+	def render(self):
+		lines = []
+		for metric in self.metrics:
+			lines += metric.render()
+		lines.append('# EOF')
+		return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+TICK = REGISTRY.histogram('tick_seconds', 'Time spent in one pass of the main loop')
+IDLE_QUERY = REGISTRY.histogram('idle_query_seconds', 'Time taken to read the idle time', ('source',))
+BUSY_PROBE = REGISTRY.histogram('busy_probe_seconds', 'Time taken to check the disk and network activity')
+BUSY_RESULTS = REGISTRY.counter('busy_probes', 'Results of the disk and network activity checks', ('result',))
+NETWORK_USAGE = REGISTRY.gauge('network_kbps', 'Network usage at the last activity check in KB/s')
+DISK_USAGE = REGISTRY.gauge('disk_mbps', 'Disk usage at the last activity check in MB/s')
+JOBS_STARTED = REGISTRY.counter('jobs_started', 'Jobs started')
+JOBS_FAILED = REGISTRY.counter('jobs_failed', 'Jobs that returned a non zero code')
+JOBS_SKIPPED = REGISTRY.counter('jobs_skipped', 'Times a job was due but held back', ('reason',))
+JOB_DURATION = REGISTRY.histogram('job_duration_seconds', 'How long each run of a job took', ('job',), JOB_BUCKETS)
+QUEUE_DEPTH = REGISTRY.gauge('queue_depth', 'Jobs waiting for a free slot')
+QUEUE_MAX = REGISTRY.gauge('queue_depth_max', 'Most jobs that have been waiting for a slot at once')
+RUNNING = REGISTRY.gauge('jobs_running', 'Jobs running right now')
+ELAPSED = REGISTRY.gauge('elapsed_seconds', 'Active (not idle) time counted by the daemon')
+IDLE = REGISTRY.gauge('idle_seconds', 'Seconds since the user last did something')
+CPU_USAGE = REGISTRY.gauge('cpu_busy_ratio', 'Fraction of CPU time busy, averaged over the last minute')
+BATTERY_CHARGE = REGISTRY.gauge('battery_charge_percent', 'Battery charge. 100 while plugged in')
+BATTERY_LEFT = REGISTRY.gauge('battery_time_left_seconds', 'Estimated time until the battery is empty')
+PLUGGED = REGISTRY.gauge('plugged_in', '1 if the computer is running on mains power')
+
+
+class Battery:
+	"Read the battery for the metrics, if there is one"
+
+	def __init__(self):
+		try:
+			self.watcher = battery_watcher.BatteryWatcher()
+		except (ValueError, TypeError, OSError):
+			self.watcher = None
+
+	def update(self):
+		if not self.watcher:
+			return
+		charge = self.watcher.check_batt()
+		plugged = self.watcher.is_plugged()
+		PLUGGED.set(int(plugged))
+		BATTERY_CHARGE.set(charge)
+		BATTERY_LEFT.set(math.inf if plugged else self.watcher.time_left(0, update=False))
+
+
+class TextfileWriter:
+	"Write the registry to filename at most once every interval seconds"
+
+	def __init__(self, filename, interval=60, registry=REGISTRY):
+		self.filename = filename
+		self.interval = interval
+		self.registry = registry
+		self.written = 0
+		self.battery = Battery()
+
+	def due(self):
+		return cur_time() - self.written >= self.interval
+
+	def next_write(self):
+		return self.written + self.interval
+
+	def write(self):
+		"Replace the file in one step so the collector never reads it half written"
+		self.battery.update()
+		tmp = self.filename + '.' + str(os.getpid()) + '.tmp'
+		with open(tmp, 'w') as f:
+			f.write(self.registry.render())
+		os.replace(tmp, self.filename)
+		self.written = cur_time()
+
+	def maybe_write(self):
+		if self.due():
+			try:
+				self.write()
+			except OSError as err:
+				print("Could not write metrics to", self.filename + ':', err)
+				self.written = cur_time()
@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+# List every upcoming window for every app in the schedule, in time order.
+# Usage: ./LazyCron.py --plan 14d [--export plan.csv]
+
+import csv
+import sys
+import math
+import json
+import time
+import heapq
+import functools
+
+import scheduler
+from daemon import read_lines
+
+from sd.chronology import cur_time, fmt_time, convert_user_time, FORMATTER
+
+
+def job_windows(proc, start, end):
+	"Yield (start, stop, proc) for each of the app's windows that open before end"
+	for win_start, win_stop in proc.windows(start):
+		if win_start >= end:
+			return
+		yield win_start, win_stop, proc
+
+
+def plan(procs, start, end):
+	'''Merge the windows of every app between start and end into one stream sorted by start time.
+	Each app's windows are generated as they are needed, so nothing is built up in memory.'''
+	return heapq.merge(*[job_windows(proc, start, end) for proc in procs], key=lambda item: item[0])
+
+
+def expected_runs(proc, length):
+	'''Predict how many times an app will run in a window of length seconds.
+	Returns (runs, kind) where kind is exact, max (frequency depends on active time) or average (random)'''
+	if proc.reqs.random:
+		if proc.freq:
+			return length / max(proc.reqs.random, proc.freq), 'average'
+		# Checked every polling cycle until it runs once
+		return 1 - math.exp(-length / proc.reqs.random), 'average'
+	if proc.freq:
+		return 1 + int(length / proc.freq), 'max'
+	return 1, 'exact'
+
+
+def fmt_runs(runs, kind):
+	if kind == 'average':
+		return '~' + str(round(runs, 2))
+	if kind == 'max':
+		return '<=' + str(runs)
+	return str(runs)
+
+
+# Lots of apps share the same start and stop times, so only format each one once
+@functools.lru_cache(maxsize=10000)
+def iso_time(timestamp):
+	return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(timestamp))
+
+
+@functools.lru_cache(maxsize=10000)
+def show_time(timestamp):
+	return FORMATTER.local(timestamp, '%a %m-%d %I:%M %p')
+
+
+class Exporter:
+	"Write each window to a .csv or .json (one object per line) file as it comes"
+	fields = ('start', 'stop', 'name', 'path', 'runs', 'estimate')
+
+	def __init__(self, filename):
+		self.file = open(filename, 'w', newline='')
+		self.json = filename.lower().endswith('.json')
+		if not self.json:
+			self.writer = csv.writer(self.file)
+			self.writer.writerow(self.fields)
+
+	def write(self, start, stop, proc, runs, kind):
+		row = (iso_time(start), iso_time(stop), proc.name, proc.path, round(runs, 3), kind)
+		if self.json:
+			self.file.write(json.dumps(dict(zip(self.fields, row))) + '\n')
+		else:
+			self.writer.writerow(row)
+
+	def close(self):
+		self.file.close()
+
+
+def print_plan(procs, horizon, export=None, verbose=1):
+	"Print every window in the next horizon seconds and a summary of the expected runs for each app"
+	timer = time.perf_counter()
+	now = cur_time()
+	end = now + horizon
+	exporter = Exporter(export) if export else None
+	totals = {proc: [0, 0] for proc in procs}     # Windows, expected runs
+	durations = functools.lru_cache(maxsize=10000)(fmt_time)
+	count = 0
+	try:
+		for start, stop, proc in plan(procs, now, end):
+			runs, kind = expected_runs(proc, min(stop, end) - max(start, now))
+			totals[proc][0] += 1
+			totals[proc][1] += runs
+			count += 1
+			if exporter:
+				exporter.write(start, stop, proc, runs, kind)
+			if verbose:
+				print(show_time(start), ' -> ', show_time(stop).ljust(20), durations(stop - start).ljust(20),
+					  fmt_runs(runs, kind).ljust(8), proc.name)
+	finally:
+		if exporter:
+			exporter.close()
+
+	print('\nPlan for the next', fmt_time(horizon) + ':', count, 'windows for', len(procs), 'apps in',
+		  fmt_time(time.perf_counter() - timer))
+	for proc, (windows, runs) in totals.items():
+		if proc.reqs.random:
+			runs = '~' + str(round(runs, 1))
+		elif proc.freq:
+			runs = 'up to ' + str(runs)
+		print(str(windows).rjust(6), 'windows', str(runs).rjust(12), 'runs', ' ', proc.name)
+	if export:
+		print('Saved to', export)
+
+
+def main(args):
+	horizon = convert_user_time(args.plan, default='days')
+	procs = [scheduler.Scheduler(line) for _key, line in read_lines(args.schedule)]
+	if not procs:
+		print("Nothing scheduled in", args.schedule)
+		sys.exit(1)
+	print_plan(procs, horizon, export=args.export, verbose=args.verbose)
@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+# Find out where the main loop spends its time.
+# Usage: ./LazyCron.py --profile [--cprofile 100]     then: kill -USR1 <pid> to print the timings
+
+import time
+import cProfile
+import contextlib
+import threading
+
+from sd.common import mkdir
+from sd.chronology import fmt_time
+
+'''
+Each phase of the loop is timed with perf_counter_ns into a histogram with one bucket per power of two nanoseconds,
+so keeping the timings costs the same after a million loops as after one. Phases can be nested (the daemon's own
+printing is timed inside the other phases), so the totals add up to more than the time spent.
+Output from job threads and other modules isn't counted.
+'''
+
+PSTATS_FILE = 'state/lazycron.pstats'
+
+
+class Phase:
+	"Histogram of how long one phase took in nanoseconds"
+
+	def __init__(self, name):
+		self.name = name
+		self.buckets = [0] * 64     # bucket n counts times from 2**(n-1) up to 2**n ns
+		self.count = 0
+		self.total = 0
+		self.longest = 0
+		self.lock = threading.Lock()
+
+	def add(self, nanoseconds):
+		with self.lock:
+			self.buckets[min(nanoseconds.bit_length(), 63)] += 1
+			self.count += 1
+			self.total += nanoseconds
+			self.longest = max(self.longest, nanoseconds)
+
+	def percentile(self, pct):
+		"Upper bound of the bucket that pct percent of the timings fall in"
+		target = self.count * pct / 100
+		seen = 0
+		for index, count in enumerate(self.buckets):
+			seen += count
+			if count and seen >= target:
+				return min(2 ** index, self.longest)
+		return self.longest
+
+
+class Timer:
+	def __init__(self, phase):
+		self.phase = phase
+		self.start = 0
+
+	def __enter__(self):
+		self.start = time.perf_counter_ns()
+		return self
+
+	def __exit__(self, *_args):
+		self.phase.add(time.perf_counter_ns() - self.start)
+
+
+class Profiler:
+	'''Time the phases of the main loop when enabled. When disabled phase() costs one attribute lookup.
+	cprofile = Also run cProfile for this many ticks and then save the stats to PSTATS_FILE'''
+
+	def __init__(self):
+		self.enabled = False
+		self.phases = dict()            # Name to Phase, in the order first seen
+		self.started = time.perf_counter_ns()
+		self.requested = False          # Print the summary at the next chance
+		self.cprofile = None
+		self.cprofile_ticks = 0
+		self.null = contextlib.nullcontext()
+
+	def enable(self, cprofile=0):
+		self.enabled = True
+		self.started = time.perf_counter_ns()
+		if cprofile:
+			self.cprofile = cProfile.Profile()
+			self.cprofile_ticks = cprofile
+
+	def phase(self, name):
+		"Context manager that adds the time spent inside it to the named phase"
+		if not self.enabled:
+			return self.null
+		phase = self.phases.get(name)
+		if phase is None:
+			phase = self.phases.setdefault(name, Phase(name))
+		return Timer(phase)
+
+	def start_tick(self):
+		if self.cprofile and self.cprofile_ticks:
+			self.cprofile.enable()
+
+	def end_tick(self):
+		"Count down the cProfile ticks and save the stats after the last one"
+		if self.cprofile and self.cprofile_ticks:
+			self.cprofile.disable()
+			self.cprofile_ticks -= 1
+			if not self.cprofile_ticks:
+				mkdir('state')
+				self.cprofile.dump_stats(PSTATS_FILE)
+				print("Saved cProfile stats to", PSTATS_FILE, "View with: python3 -m pstats", PSTATS_FILE)
+				self.cprofile = None
+		if self.requested:
+			self.requested = False
+			self.summary()
+
+	def request(self, *_args):
+		"Signal handler: print the summary at the end of the next tick"
+		self.requested = True
+
+	def summary(self):
+		"Print a table of every phase"
+		rows = [('Phase', 'Count', 'Total', 'Mean', 'p50', 'p99', 'Longest')]
+		fmt = lambda ns: fmt_time(ns / 1e9)
+		for phase in sorted(self.phases.values(), key=lambda phase: phase.total, reverse=True):
+			if phase.count:
+				rows.append((phase.name, str(phase.count), fmt(phase.total), fmt(phase.total / phase.count),
+							 fmt(phase.percentile(50)), fmt(phase.percentile(99)), fmt(phase.longest)))
+		widths = [max(len(row[col]) for row in rows) for col in range(len(rows[0]))]
+		print('\nTimings for', fmt_time((time.perf_counter_ns() - self.started) / 1e9), 'of running:')
+		for row in rows:
+			print('  '.join(item.ljust(width) for item, width in zip(row, widths)).rstrip())
+
+
+PROFILER = Profiler()
@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+# Limit how many jobs run at once. Jobs that are due wait here for a free slot.
+
+import heapq
+import itertools
+from collections import deque
+
+from sd.common import avg
+from sd.chronology import fmt_time, cur_time
+
+
+class RunQueue:
+	'''Daemon wide queue of jobs that are due to run.
+	Higher priorities go first, jobs with the same priority go in the order they came due.
+	max_jobs = Maximum number of jobs running at once. 0 = No limit'''
+
+	def __init__(self, max_jobs=0):
+		self.max_jobs = max_jobs
+		self.heap = []                  # (-priority, sequence number, time queued, proc)
+		self.queued = set()             # Procs waiting in the queue
+		self.counter = itertools.count()
+		self.waits = deque(maxlen=256)  # Recent times spent waiting in queue
+		self.max_depth = 0              # Longest the queue has been
+
+	def __len__(self):
+		return len(self.heap)
+
+	def __contains__(self, proc):
+		return proc in self.queued
+
+	def push(self, proc):
+		"Add a job that is due. Returns False if it's already waiting"
+		if proc in self.queued:
+			return False
+		heapq.heappush(self.heap, (-proc.priority, next(self.counter), cur_time(), proc))
+		self.queued.add(proc)
+		self.max_depth = max(self.max_depth, len(self.heap))
+		return True
+
+	def dispatch(self, running, keep=None):
+		'''Yield (proc, seconds waited) for each job that can start now.
+		running = number of jobs already running
+		keep    = optional set of procs still in the schedule. Others are dropped'''
+		while self.heap and (not self.max_jobs or running < self.max_jobs):
+			_priority, _count, queued, proc = heapq.heappop(self.heap)
+			self.queued.discard(proc)
+			if keep is not None and proc not in keep:
+				continue
+			waited = cur_time() - queued
+			self.waits.append(waited)
+			running += 1
+			yield proc, waited
+
+	def oldest(self):
+		"Seconds the longest waiting job has been in the queue"
+		if not self.heap:
+			return 0
+		return cur_time() - min(item[2] for item in self.heap)
+
+	def status(self):
+		"One line summary of the queue"
+		text = 'Queue: ' + str(len(self)) + ' waiting'
+		if self.heap:
+			text += ', oldest ' + fmt_time(self.oldest())
+		if self.waits:
+			text += ', average wait ' + fmt_time(avg(self.waits)) + ', max depth ' + str(self.max_depth)
+		return text
@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+# Keep measuring disk, network and CPU activity in the background so the daemon never waits on a probe.
+# Usage: ./sampler.py to watch the numbers
+
+import math
+import time
+import threading
+from collections import deque
+
+import how_busy
+from sd.common import spawn, auto_cols
+
+'''
+Every interval seconds the sampler reads /proc/diskstats, /proc/net/dev and /proc/stat once each (no subprocesses)
+and works out the rates since the last pass. Each rate goes into a Series which keeps:
+	a ring buffer of the last history seconds for moving averages
+	exponentially weighted moving averages (EWMA) over 1, 5 and 15 minutes, like the load average
+'''
+
+EWMA_TIMES = (60, 300, 900)     # Seconds
+
+
+class Series:
+	"Ring buffer of (time, value) with EWMAs"
+
+	def __init__(self, length, taus=EWMA_TIMES):
+		self.samples = deque(maxlen=length)
+		self.ewmas = {tau: None for tau in taus}
+		self.lock = threading.Lock()
+
+	def add(self, when, value):
+		with self.lock:
+			if self.samples:
+				# Works with uneven gaps between samples
+				gap = when - self.samples[-1][0]
+				for tau, old in self.ewmas.items():
+					self.ewmas[tau] = old + (1 - math.exp(-gap / tau)) * (value - old)
+			else:
+				self.ewmas = dict.fromkeys(self.ewmas, value)
+			self.samples.append((when, value))
+
+	def latest(self):
+		"The most recent value, or None"
+		with self.lock:
+			return self.samples[-1][1] if self.samples else None
+
+	def average(self, seconds):
+		"Moving average of the values in the last seconds, or None if there aren't any"
+		with self.lock:
+			if not self.samples:
+				return None
+			since = self.samples[-1][0] - seconds
+			values = [value for when, value in reversed(self.samples) if when > since]
+		return sum(values) / len(values)
+
+	def ewma(self, tau=EWMA_TIMES[0]):
+		with self.lock:
+			return self.ewmas[tau]
+
+	def span(self):
+		"Seconds of measurements in the buffer"
+		with self.lock:
+			if not self.samples:
+				return 0
+			return self.samples[-1][0] - self.samples[0][0]
+
+
+class LoadSampler:
+	'''Background thread that samples the disks, network and CPU every interval seconds.
+	series = dict of name to Series:
+		disk = MB/s read and written
+		net  = KB/s sent and received
+		cpu  = Fraction of CPU time busy (0 to 1)
+		disk:<name> = Fraction of the time one disk was busy (0 to 1), for each disk added with watch()'''
+
+	def __init__(self, interval=2, history=900):
+		self.interval = interval
+		self.length = int(history / interval) + 1
+		self.series = dict(disk=Series(self.length), net=Series(self.length), cpu=Series(self.length))
+		self.devices = set()            # Disks with their own series
+		self.stats = dict(disk=how_busy.get_diskstats(), net=how_busy.get_netstats(), cpu=how_busy.CpuStats())
+		self.last = None                # Snapshots from the last pass
+		self.started = None             # Monotonic time of the first sample
+		self.thread = None
+		self.stop_event = threading.Event()
+
+	def sample(self):
+		"Take one set of snapshots and add the rates since the last set to each series"
+		snapshots = {name: stats.snapshot() for name, stats in self.stats.items()}
+		if self.last:
+			when = snapshots['cpu'][0]
+			old = self.last
+			self.series['disk'].add(when, how_busy.total_mbps(self.stats['disk'].usage(old['disk'], snapshots['disk'])))
+			self.series['net'].add(when, how_busy.total_kbps(self.stats['net'].usage(old['net'], snapshots['net'])))
+			self.series['cpu'].add(when, self.stats['cpu'].usage(old['cpu'], snapshots['cpu']))
+			if self.devices:
+				table = self.stats['disk'].usage(old['disk'], snapshots['disk'], devices=set(self.devices))
+				for dev, usage in table.items():
+					self.series['disk:' + dev].add(when, usage.util)
+		else:
+			self.started = snapshots['cpu'][0]
+		self.last = snapshots
+
+	def run(self):
+		while not self.stop_event.is_set():
+			self.sample()
+			self.stop_event.wait(self.interval)
+
+	def start(self):
+		if not self.thread:
+			_que, self.thread = spawn(self.run)
+		return self
+
+	def stop(self):
+		self.stop_event.set()
+
+	def watch(self, dev):
+		"Start keeping a series of how busy the disk named dev is, called disk:<dev>"
+		if dev not in self.devices:
+			self.series['disk:' + dev] = Series(self.length)
+			self.devices.add(dev)
+		return 'disk:' + dev
+
+	def warmed_up(self, seconds):
+		"Has the sampler been running long enough to average over seconds?"
+		return self.started is not None and time.monotonic() - self.started >= seconds
+
+	def remaining(self, seconds):
+		"Seconds until warmed_up(seconds) will be True"
+		if self.started is None:
+			return seconds + self.interval
+		return max(0, self.started + seconds - time.monotonic())
+
+	def average(self, name, seconds):
+		return self.series[name].average(seconds)
+
+	def latest(self, name):
+		return self.series[name].latest()
+
+	def ewma(self, name, tau=EWMA_TIMES[0]):
+		return self.series[name].ewma(tau)
+
+	def status(self):
+		"Table of the latest value, the 20 second average and the EWMAs for each series"
+		out = [['', 'Now', '20s avg'] + ['EWMA ' + str(tau // 60) + 'm' for tau in EWMA_TIMES]]
+		for name, series in self.series.items():
+			row = [name, series.latest(), series.average(20)] + [series.ewma(tau) for tau in EWMA_TIMES]
+			out.append([row[0]] + ['-' if val is None else round(val, 3) for val in row[1:]])
+		return out
+
+
+SAMPLER = None
+
+
+def get_sampler(interval=2):
+	"Return the shared LoadSampler, starting it the first time"
+	global SAMPLER		# pylint: disable=global-statement
+	if not SAMPLER:
+		SAMPLER = LoadSampler(interval).start()
+	return SAMPLER
+
+
+if __name__ == "__main__":
+	SAMPLER = get_sampler()
+	while True:
+		time.sleep(5)
+		auto_cols(SAMPLER.status())
+		print()
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+# Save the parsed schedule so an unchanged schedule file loads without running the text parsers again.
+
+import os
+import time
+import pickle
+import hashlib
+
+from sd.common import mkdir
+
+
+class ScheduleCache:
+	'''Parsed schedule lines saved to disk.
+	The whole file is keyed by a hash of its contents (and the year, because dates like March 14 are parsed
+	into this year). Each job is also kept by job id, so editing one line only reparses that line.
+	readonly = Use the saved cache but never write it (testing mode)'''
+
+	VERSION = 3
+
+	def __init__(self, filename, readonly=False):
+		self.filename = filename
+		self.readonly = readonly
+		self.key = None                 # Hash of the schedule file that lines came from
+		self.lines = []                 # (job id, line dict) for every line in the schedule
+		self.jobs = dict()              # job id to Scheduler.compiled()
+		self.changed = False
+		if os.path.dirname(filename) and not readonly:
+			mkdir(os.path.dirname(filename))
+		self.load()
+
+	def load(self):
+		try:
+			with open(self.filename, 'rb') as f:
+				data = pickle.load(f)
+		except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+			return
+		if data.get('version') == self.VERSION and data.get('year') == time.strftime('%Y'):
+			self.key = data['key']
+			self.lines = data['lines']
+			self.jobs = data['jobs']
+
+	def save(self):
+		"Save to disk if anything changed"
+		if not self.changed or self.readonly:
+			return
+		tmp = self.filename + '.tmp'
+		with open(tmp, 'wb') as f:
+			pickle.dump(dict(version=self.VERSION, year=time.strftime('%Y'), key=self.key, lines=self.lines, jobs=self.jobs), f,
+						protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(tmp, self.filename)
+		self.changed = False
+
+	@staticmethod
+	def hash_file(filename):
+		with open(filename, 'rb') as f:
+			data = f.read()
+		return hashlib.sha256(data + time.strftime('%Y').encode()).hexdigest()
+
+	def get_lines(self, schedule_file):
+		"Return the cached lines if the schedule file hasn't changed, otherwise None"
+		key = self.hash_file(schedule_file)
+		if key == self.key:
+			return self.lines
+		self.key = key
+		return None
+
+	def set_lines(self, lines):
+		self.lines = lines
+		self.changed = True
+
+	def get_job(self, job_id):
+		return self.jobs.get(job_id)
+
+	def set_jobs(self, procs):
+		"Replace the saved jobs with procs"
+		self.jobs = {proc.job_id: proc.compiled() for proc in procs}
+		self.changed = True
@@ -1,21 +1,29 @@
 #!/usr/bin/python3
 
 import os
+import math
 import time
 import random
 import shutil
+import hashlib
 import datetime
 import subprocess
 from datetime import datetime as dada
 
+import sampler
+import how_busy
+import job_logs
+import job_limits
+import accounting
 import battery_watcher
 
-from sd.chronology import local_time, seconds_since_midnight, fmt_time
-from sd.chronology import convert_user_time, udate, convert_ut_range, add_date
+from sd.chronology import local_time, fmt_time, cur_time, FORMATTER
+from sd.chronology import convert_user_time, udate, convert_ut_range
 
 from sd.common import spawn, mkdir, joiner, indenter, safe_filename, error
-from sd.common import search_list, read_state, DotDict, Eprinter, warn, read_val
+from sd.common import search_list, read_state, DotDict, Eprinter, warn, read_val, convert_user_size
 
+INF = float('inf')
 EP = Eprinter()
 eprint = EP.eprint			# pylint: disable=C0103
 
@@ -34,6 +42,22 @@ def is_val(var):
 	return len(var) > 1 or var.isdigit()
 
 
+LOAD_WINDOW = 10                # Seconds of sampler measurements averaged for the cpu, disk, net and quiet requirements
+
+
+def sampled(name, seconds=LOAD_WINDOW):
+	"Average of a background sampler series over the last seconds, like cpu or disk. None until it has data"
+	return sampler.get_sampler().average(name, seconds)
+
+
+def disk_busy(path, seconds=LOAD_WINDOW):
+	"Fraction of the time the disk holding path was busy, or None if it can't be found or hasn't been measured yet"
+	dev = how_busy.block_device(path)
+	if not dev:
+		return None
+	return sampled(sampler.get_sampler().watch(dev), seconds)
+
+
 def lid_open():
 	return read_state("/proc/acpi/button/lid/LID0/state").split()[1] == "open"
 
@@ -47,81 +71,179 @@ def is_plugged():
 		return True
 
 
-def get_day(day, cycle, today=None):
-	"Given a day of the week/month/year, return the next occurence"
-	if not today:
-		today = dada(*dada.now().timetuple()[:3])
-	if cycle == 'week':
-		delta = datetime.timedelta((day - today.weekday()))
-		if delta.days < 0:
-			delta += datetime.timedelta(7)
-	elif cycle == 'month':
-		delta = datetime.timedelta((day - today.day))
-		if delta.days < 0:
-			delta = add_date(today, months=1).replace(day=day) - today
-	elif cycle == 'year':
-		month, day = day
-		date = today.replace(month=month, day=day)
-		if date < today:
-			date = date.replace(year=date.year)
-		return date
-	else:
-		error('cycle', cycle, "unsupported")
-	return today + delta
+class Sensors:
+	"The lid and power cord, as seen by Scheduler.ready(). The simulator passes in its own"
 
+	@staticmethod
+	def lid_open():
+		return lid_open()
 
-def run_proc(cmd, log):
-	"Spawned thread by Scheduler to run a command and then write to log if needed."
-	ofilename = log+'.log'
-	efilename = log+'.err'
-	assert not os.path.exists(ofilename)
-	assert not os.path.exists(efilename)
+	@staticmethod
+	def is_plugged():
+		return is_plugged()
+
+
+SENSORS = Sensors()
+
+
+def print_status(procs):
+	"Print one line for each app with its next window, formatting all of the times in one pass"
+	procs = list(procs)
+	starts = FORMATTER.local_many([proc.start for proc in procs])
+	stops = FORMATTER.local_many([proc.stop for proc in procs])
+	freqs = FORMATTER.durations([proc.freq for proc in procs])
+	width = min(max([len(proc.name) for proc in procs] + [4]), 40)
+	print('Name'.ljust(width), 'Start'.ljust(16), 'Stop'.ljust(16), 'Freq'.ljust(16), 'Priority')
+	for proc, start, stop, freq in zip(procs, starts, stops, freqs):
+		print(proc.name[:width].ljust(width), start.ljust(16), stop.ljust(16), (freq if proc.freq else '*').ljust(16),
+			  proc.priority)
+
+
+def next_day(day, cycle, today):
+	'''Given a day of the week or month, return the next date on or after today that it falls on, or None.
+	Counted weekdays like 2nd Thursday (7 + 3) are that many days on from the start of this week.'''
+	if cycle == 'week':
+		delta = day - today.weekday()
+		if delta < 0:
+			delta += 7
+		return today + datetime.timedelta(days=delta)
+	# Day of the month, skipping months that are too short for it
+	year, month = today.year, today.month
+	if today.day > day:
+		month += 1
+	for _ in range(48):
+		if month > 12:
+			year, month = year + 1, 1
+		try:
+			return datetime.date(year, month, day)
+		except ValueError:
+			month += 1
+	return None
 
-	ofile = open(ofilename, mode='w')
-	efile = open(efilename, mode='w')
 
-	ret = subprocess.run(cmd, check=False, stdout=ofile, stderr=efile, shell=True)
-	code = ret.returncode
+def year_date(date, year):
+	"date moved to year, or the next year it exists in (February 29th)"
+	for offset in range(8):
+		try:
+			return datetime.date(year + offset, date.month, date.day)
+		except ValueError:
+			continue
+	return None
+
+
+def date_span(rule, today):
+	'''Return the (first day, last day) of a (start, end, cycle) date rule whose last day is the next one on or after today.
+	The first day can be before today if the span has already started. None if it never comes around.'''
+	first, last, cycle = rule
+	if cycle == 'year':
+		start, stop = year_date(first, today.year), year_date(last, today.year)
+		if start and stop and start > stop:
+			# Wraps around the new year like dec 30-jan 2
+			start = year_date(first, today.year - 1)
+		if stop and today > stop:
+			start, stop = year_date(first, start.year + 1), year_date(last, stop.year + 1)
+		return (start, stop) if start and stop else None
+	stop = next_day(last, cycle, today)
+	if stop is None:
+		return None
+	if last >= first:
+		return stop - datetime.timedelta(days=last - first), stop
+	# Wraps around like fri-mon or 25-5
+	if cycle == 'week':
+		return stop - datetime.timedelta(days=(last - first) % 7), stop
+	start = stop
+	for _ in range(62):
+		start -= datetime.timedelta(days=1)
+		if start.day == first:
+			return start, stop
+	return None
+
+
+def job_id(args):
+	"Stable id for a schedule line. Any change to the line makes it a different job"
+	text = '\t'.join(str(args[key]) for key in sorted(args))
+	return hashlib.sha1(text.encode()).hexdigest()[:12]
+
+
+def failure_popup(cmd, code, efilename):
+	"Warn about a failed command and return the zenity command to tell the desktop, if available"
+	print()
+	warn(cmd, "\nReturned code", code)
+	print("Errors in:", efilename)
+	if shutil.which('zenity'):
+		text = (cmd, "returned code", str(code), '\n', 'Errors in', efilename)
+		return ['zenity', '--width', '600', '--info', '--timeout=99999999', '--text='+' '.join(text)]
+	print("Install zenity to get this message on the desktop.")
+	return None
+
+
+def run_proc(cmd, log, limits=None):
+	'''Spawned thread by Scheduler to run a command and stream its output into the job's logs. Returns the Run
+	limits = dict from job_limits.parse to apply to the job'''
+	run = job_logs.get_log(log).start_run(cmd)
+	started = time.monotonic()
+	proc = subprocess.Popen(job_limits.command(cmd, limits, os.path.basename(log)),
+							stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	job_logs.stream_output(proc, run)
+	code, usage = accounting.wait_proc(proc, started)
+	run.finish(code, usage)
 
 	if code:
-		print()
-		warn(cmd, "\nReturned code", code)
-		print("Errors in:", efilename)
-		if shutil.which('zenity'):
-			text = (cmd, "returned code", str(code), '\n', 'Errors in', efilename)
-			zcmd = ['zenity', '--width', '600', '--info', '--timeout=99999999', '--text='+' '.join(text)]
+		zcmd = failure_popup(cmd, code, run.err_name)
+		if zcmd:
 			subprocess.run(zcmd, check=False)
-		else:
-			print("Install zenity to get this message on the desktop.")
+	return run
 
-	if not os.path.getsize(ofilename):
-		os.remove(ofilename)
-	if not os.path.getsize(efilename):
-		os.remove(efilename)
+
+def launch_thread(cmd, log, on_done=None, limits=None):
+	"Run a command in a seperate thread and return the thread. Calls on_done(run) when finished"
+	def job():
+		run = None
+		try:
+			run = run_proc(cmd, log, limits)
+		finally:
+			if on_done:
+				on_done(run)
+
+	_que, thread = spawn(job)
+	return thread
 
 
 
 class Scheduler:
 	"Spawn processes during windows of time when certain conditions are met"
 
-	def __init__(self, args):
-		"Defaults:"
+	def __init__(self, args, parsed=None):
+		'''Defaults:
+		parsed = output of compiled() saved from an earlier run, so the text doesn't need parsing again'''
 		self.window = []            # Start and stop times
 		self.date_window = []       # Allowed days
 		self.start = 0              # Start time in UTC
 		self.stop = 0               # End time in UTC
 		self.freq = 0               # Frequency
+		self.priority = 0           # Higher priorities start first when jobs are waiting for a slot
+		self.limits = dict()        # nice, ionice, cpus, rlimits and cgroup settings from job_limits.parse
 		self.history = []           # When the app last ran
+		self.usage = None           # accounting.Usage of the last run that finished
+		self.blocked = None         # The requirement that stopped ready() the last time
+		self.last_roll = None       # Time of the last roll for the random requirement
+		self.upcoming = None        # Generator of windows after the current one
+		self.next_window = None     # Next (start, stop) after the current window
 
 		self.last_elapsed = 0       # Last elapsed time at run
 		self.last_run = 0           # Last time the script was run
 		self.next_elapsed = 0       # Next run time
 
 		self.args = args            # Preserve initial setup args
+		self.job_id = job_id(args)  # Key for saving state across restarts
 		self.path = args['path']    # Path to script
 		self.thread = None          # Thread starting running process
 		self.log_dir = 'logs'
 		mkdir(self.log_dir)
+
+		if parsed:
+			self.load_compiled(parsed)
+			return
 		name = list(indenter(os.path.basename(self.path), wrap=64))
 		if len(name) > 1:
 			self.name = name[0].rstrip(',') + '...'
@@ -132,19 +254,71 @@ class Scheduler:
 		self.calc_window()
 
 
+	def compiled(self):
+		"Return everything parsed from the schedule line in a form that can be saved to the cache"
+		return dict(name=self.name, window=self.window, date_window=self.date_window, freq=self.freq,
+					priority=self.priority, reqs=dict(self.reqs), limits=self.limits, start=self.start, stop=self.stop)
+
+	def load_compiled(self, parsed):
+		"Load the output of compiled() instead of parsing the schedule line"
+		self.name = parsed['name']
+		self.window = parsed['window']
+		self.date_window = parsed['date_window']
+		self.freq = self.next_elapsed = parsed['freq']
+		self.priority = parsed['priority']
+		self.limits = parsed['limits']
+		self.reqs = DotDict(parsed['reqs'])
+		if parsed['stop'] >= cur_time():
+			# Still the earliest window that hasn't closed yet
+			self.start = parsed['start']
+			self.stop = parsed['stop']
+		else:
+			self.calc_window()
+
+
 	def process_reqs(self, arg):
-		arg = arg.lower().strip()
+		text = arg.strip()              # Paths keep their case
+		arg = text.lower()
 		match = search_list(arg.split()[0], self.reqs.keys(), getfirst=True)
 		if match:
+			previous = self.reqs[match]
 			self.reqs[match] = True
 		else:
 			error("Can't find requirement:", arg)
+		# Text after the requirement name without any < or <=, like: 50% in cpu < 50% or io 20 in pressure io < 20
+		value = ' '.join(word.lstrip('<=') for word in arg.split()[1:] if word.lstrip('<='))
 		if match == 'idle':
 			self.reqs.idle = convert_user_time(''.join(arg.split('idle')[1:]))
 		if match == 'busy':
 			self.reqs.busy = convert_user_time(''.join(arg.split('busy')[1:]))
 		if match == 'random':
 			self.reqs.random = convert_user_time(''.join(arg.split('random')[1:]))
+		try:
+			if match == 'cpu':
+				self.reqs.cpu = float(value.rstrip('%'))
+			if match == 'load':
+				self.reqs.load = float(value)
+			if match == 'mem':
+				self.reqs.mem = convert_user_size(value, default='mb')
+			if match == 'disk':
+				self.reqs.disk = convert_user_size(value.replace('/s', ''), default='mb')
+			if match == 'net':
+				self.reqs.net = convert_user_size(value.replace('/s', ''), default='kb')
+			if match == 'quiet':
+				words = text.split()[1:]
+				limit = 10
+				if len(words) > 1 and words[-1].endswith('%'):
+					limit = float(words.pop().rstrip('%'))
+				if not words:
+					raise ValueError
+				self.reqs.quiet = (os.path.expanduser(' '.join(words)), limit)
+			if match == 'pressure':
+				kind, limit = value.split()
+				if kind not in how_busy.PRESSURE_TYPES:
+					raise ValueError
+				self.reqs.pressure = dict(previous or {}, **{kind: float(limit.rstrip('%'))})
+		except ValueError:
+			error("Can't read requirement:", arg)
 
 
 	def process_time(self, section):
@@ -172,7 +346,8 @@ class Scheduler:
 
 	def process_args(self):
 		args = self.args
-		self.reqs = DotDict(plugged=False, idle=0, busy=0, closed=False, random=0)
+		self.reqs = DotDict(plugged=False, idle=0, busy=0, closed=False, random=0, cpu=0, load=0, mem=0, pressure=None,
+							disk=0, net=0, quiet=None)
 		for key, values in args.items():
 			if set(values) == {'*'}:
 				continue
@@ -186,6 +361,25 @@ class Scheduler:
 				if key == 'frequency':
 					self.freq = convert_user_time(val)
 					self.next_elapsed = self.freq
+				if key == 'limits':
+					try:
+						job_limits.parse(val, self.limits)
+					except ValueError as err:
+						error(err)
+				if key == 'priority':
+					try:
+						self.priority = int(val)
+					except ValueError:
+						error("Priority must be a whole number:", val)
+
+	def restore(self, saved):
+		"Restore the run history saved in the journal"
+		if not saved or not saved.history:
+			return
+		self.history = list(saved.history)
+		self.last_run = self.history[-1]
+		self.last_elapsed = saved.last_elapsed
+		self.next_elapsed = saved.last_elapsed + self.freq
 
 	def __str__(self):
 		return str({key: val for key, val in self.__dict__.items() if key != 'args'})
@@ -197,14 +391,22 @@ class Scheduler:
 		"Print a detailed representation of each app"
 
 		print('Name: ', self.name)
-		if self.window or self.date_window:
-			now = time.time()
-			print('Start:', local_time(self.start, '%a %m-%d %I:%M %p'), '=', fmt_time(self.start - now))
-			print('Stop: ', local_time(self.stop, '%a %m-%d %I:%M %p'), '=', fmt_time(self.stop - now))
+		if self.start == INF:
+			print('Start: never (no upcoming window)')
+		elif self.window or self.date_window:
+			now = cur_time()
+			start, stop = FORMATTER.local_many((self.start, self.stop), '%a %m-%d %I:%M %p')
+			until_start, until_stop = FORMATTER.durations((self.start - now, self.stop - now))
+			print('Start:', start, '=', until_start)
+			print('Stop: ', stop, '=', until_stop)
 		if self.freq:
 			print('Freq: ', fmt_time(self.freq))
 		print('Path: ', self.path)
 		print('Reqs: ', self.reqs)
+		if self.priority:
+			print('Priority:', self.priority)
+		if self.limits:
+			print('Limits:', self.limits)
 		print('in_window:', self.in_window())
 
 
@@ -217,133 +419,201 @@ class Scheduler:
 		# return ps_running(self.path)
 
 
-	def calc_date(self, extra=0):
-		"Get seconds until next date when allowed to run"
-		inf = float("inf")
-		new_start = inf
-		new_stop = 0
-		today = dada(*dada.now().timetuple()[:3]) + datetime.timedelta(days=extra)
-		for sd, ed, cycle in self.date_window:
-			if cycle == 'year':
-				if today > ed:
-					sd = sd.replace(year=sd.year+1)		#Start Date
-					ed = ed.replace(year=ed.year+1)		#End Date
-				start = sd.timestamp()
-				stop = ed.timestamp()
+	def window_after(self, now):
+		'''Return the (start, stop) window that is current or comes next at now, or None if there will never be one.
+		A date range is one span of days: 9am-5pm with m-f is one window from Monday 9am to Friday 5pm.
+		Out of several date rules or time windows, the one that starts first wins.'''
+		today = dada.fromtimestamp(now).date()
+		for extra in range(2):
+			# If every window for today's spans has closed, look again from tomorrow
+			day = today + datetime.timedelta(days=extra)
+			if self.date_window:
+				spans = [span for span in (date_span(rule, day) for rule in self.date_window) if span]
+				if not spans:
+					return None
+				first, last = min(spans, key=lambda span: span[0])
 			else:
-				stop = get_day(ed, cycle, today=today).timestamp()
-				start = stop - (ed - sd) * 86400
-			if start < new_start:
-				new_start = start
-				new_stop = stop
-		return new_start, new_stop
-
-
-	def calc_window(self):
-		"Calculate the next start and stop window for the proc in unix time"
-		inf = float("inf")
-		now = time.time()
-		midnight = round(now - seconds_since_midnight())
-		if self.date_window:
-			self.start, self.stop = self.calc_date()
-		else:
-			self.start = midnight
-			self.stop = midnight
-
-		def get_first():
-			"Find earliest start, return True if updated."
-			new_start = inf
+				first = last = day
+			start_day = dada.combine(first, datetime.time())
+			stop_day = dada.combine(last, datetime.time())
+			if not self.window:
+				return start_day.timestamp(), (stop_day + datetime.timedelta(days=1)).timestamp() - 1
+			best = None
 			for start, stop in self.window:
 				if stop < start:
 					stop += 86400
-				start += self.start
-				stop += self.stop
-				if start < new_start and stop > now:
-					new_start = start
-					new_stop = stop
-			if new_start < inf:
-				self.start = new_start
-				self.stop = new_stop
-				return True
-			return False
+				window = ((start_day + datetime.timedelta(seconds=start)).timestamp(),
+						  (stop_day + datetime.timedelta(seconds=stop)).timestamp())
+				if window[1] > now and (not best or window[0] < best[0]):
+					best = window
+			if best:
+				return best
+		return None
+
+	def windows(self, after=None):
+		"Yield every (start, stop) window in unix time that hasn't closed by after, in order"
+		if after is None:
+			after = cur_time()
+		while True:
+			window = self.window_after(after)
+			if not window:
+				return
+			yield window
+			after = window[1] + 1
+
 
-		if self.window:
-			if not get_first():
-				#If the stop time is in the past, shift time forward and calculate again.
-				if not self.date_window:
-					self.start += 86400
-					self.stop += 86400
-				else:
-					self.start, self.stop = self.calc_date(extra=1)
-				get_first()
+	def calc_window(self):
+		"Move on to the earliest window that hasn't closed yet, keeping the one after it ready"
+		now = cur_time()
+		if self.start == INF:
+			# There will never be a window. Kept until the schedule line changes, which makes a new Scheduler
+			return
+		if self.next_window and now <= self.next_window[1]:
+			self.start, self.stop = self.next_window
 		else:
-			self.stop += 86400 - 1 	#So it stops just before next day
+			self.upcoming = self.windows(now)
+			self.start, self.stop = next(self.upcoming, (INF, INF))
+		self.next_window = next(self.upcoming, (INF, INF))
 
 		if self.history and (self.window or self.date_window):
-			if self.start > now:
+			if self.start == INF:
+				print("No upcoming windows for", self.name)
+			elif self.start > now:
 				print("Next run in", fmt_time(self.start - now), 'for', self.name)
 			else:
 				print("Time window for", self.name, 'closes in', fmt_time(self.stop - now))
 
-		if not now <= self.stop:
-			error('miscalculation!', self.name, now, 'start', self.start, 'stop', self.stop)
-
 
 	def in_window(self):
-		"Check if within time window to run, otherwise recalculate a new time window"
-		now = time.time()
-		if now < self.start:
-			return False
-		if self.start <= now <= self.stop:
-			if not self.freq and self.start <= self.last_run <= self.stop:
-				# print("Already ran in this window")
-				return False
-			return True
-		else:
-			# Recalculate
+		"Check if within time window to run, moving on to the next window once this one closes"
+		now = cur_time()
+		if now > self.stop:
 			self.calc_window()
-			return self.in_window()
+		if not self.start <= now <= self.stop:
+			return False
+		if not self.freq and self.start <= self.last_run <= self.stop:
+			# print("Already ran in this window")
+			return False
+		return True
 
-	def run(self, elapsed, polling_rate, testing_mode, idle=0):
-		"Run the process in seperate thread while appending info to log."
+	def wakeups(self, elapsed, idle):
+		'''Yield the future times (and reasons) when this app could become ready to run.
+		Anything that can't be predicted like the lid or power cord is left to polling.'''
+		now = cur_time()
+		if self.in_window():
+			if self.next_elapsed > elapsed:
+				# Active time can't build up faster than real time.
+				yield now + self.next_elapsed - elapsed, 'frequency'
+			if self.reqs.idle > idle:
+				yield now + self.reqs.idle - idle, 'idle'
+		elif now < self.start:
+			yield self.start, 'window opens'
+		yield self.stop + 1, 'window closes'
+
+	def run(self, elapsed, polling_rate, testing_mode, idle=0, launch=launch_thread):
+		'''Run the process in seperate thread while appending info to log.
+		launch = function(cmd, log) that starts the process and returns an object with is_alive()'''
+		if not self.ready(polling_rate, idle):
+			return False
+		self.start_proc(elapsed, testing_mode, launch)
+		return True
+
+	def ready(self, polling_rate, idle=0, sensors=SENSORS):
+		'''Check the requirements and make sure the process isn't already running. Sets self.blocked to the reason if not
+		sensors = Where to read the lid and power cord from'''
+		self.blocked = None
 		if self.reqs:
-			if self.reqs.closed and lid_open():
+			if self.reqs.closed and sensors.lid_open():
 				eprint("\tLid not closed", v=-1)
-				return False
-			if self.reqs.plugged and not is_plugged():
+				self.blocked = 'closed'
+			elif self.reqs.plugged and not sensors.is_plugged():
 				eprint("\tNot plugged in", v=-1)
-				return False
-			if self.reqs.idle > idle:
+				self.blocked = 'plugged'
+			elif self.reqs.idle > idle:
 				eprint("\tIdle time not reached", v=-1)
-				return False
-			if self.reqs.busy and idle > self.reqs.busy:
+				self.blocked = 'idle'
+			elif self.reqs.busy and idle > self.reqs.busy:
 				eprint("\tIdle for too long:", idle, '>', self.reqs.busy, v=-1)
-				return False
-			if self.reqs.random and random.random() > polling_rate / self.reqs.random:
+				self.blocked = 'busy'
+			elif self.reqs.random and not self.roll(polling_rate):
+				self.blocked = 'random'
+			else:
+				self.blocked = self.check_load()
+			if self.blocked:
 				return False
 		if self.running():
 			print("\tStill running!")
+			self.blocked = 'running'
 			return False
+		return True
 
+	def roll(self, polling_rate):
+		'''Roll for the random requirement. The chance depends on the time since the last roll, so it runs on average
+		once every reqs.random seconds however often the loop checks. Gaps are capped at polling_rate so a job
+		that hasn't been checked for a while (outside its window) doesn't start as soon as it's allowed to.'''
+		now = cur_time()
+		gap = polling_rate if self.last_roll is None else min(max(now - self.last_roll, 0), polling_rate)
+		self.last_roll = now
+		return random.random() < 1 - math.exp(-gap / self.reqs.random)
+
+	def check_load(self):
+		'''Check the requirements measured from /proc: cpu, load, mem, pressure, disk, net and quiet.
+		Returns the first one not met or None. Rates come from the background sampler, so nothing waits here'''
+		if self.reqs.cpu:
+			usage = sampled('cpu')
+			if usage is None or usage * 100 > self.reqs.cpu:
+				eprint("\tCPU usage too high:", usage, v=-1)
+				return 'cpu'
+		if self.reqs.load and how_busy.load_average() > self.reqs.load:
+			eprint("\tLoad average too high:", how_busy.load_average(), v=-1)
+			return 'load'
+		if self.reqs.mem and how_busy.mem_available() < self.reqs.mem:
+			eprint("\tNot enough memory available:", how_busy.mem_available(), v=-1)
+			return 'mem'
+		for kind, limit in (self.reqs.pressure or {}).items():
+			stalled = how_busy.pressure(kind)
+			if stalled is not None and stalled > limit:
+				eprint("\tToo much", kind, "pressure:", stalled, v=-1)
+				return 'pressure'
+		if self.reqs.disk:
+			rate = sampled('disk')
+			if rate is None or rate * how_busy.MB > self.reqs.disk:
+				eprint("\tDisk usage too high:", rate, 'MB/s', v=-1)
+				return 'disk'
+		if self.reqs.net:
+			rate = sampled('net')
+			if rate is None or rate * how_busy.KB > self.reqs.net:
+				eprint("\tNetwork usage too high:", rate, 'KB/s', v=-1)
+				return 'net'
+		if self.reqs.quiet:
+			path, limit = self.reqs.quiet
+			busy = disk_busy(path)
+			if busy is None or busy * 100 > limit:
+				eprint("\tDisk holding", path, "not quiet:", busy, v=-1)
+				return 'quiet'
+		return None
+
+
+	def start_proc(self, elapsed, testing_mode, launch=launch_thread):
+		"Start the process without checking requirements. Returns True if it actually started"
 		self.last_elapsed = elapsed
-		self.last_run = int(time.time())
+		self.last_run = int(cur_time())
 		self.next_elapsed = elapsed + self.freq
 
-		filename = safe_filename(self.name + '.' + str(int(time.time())))
-		log_file = os.path.abspath(os.path.join(self.log_dir, filename))
+		log_file = os.path.abspath(os.path.join(self.log_dir, safe_filename(self.name)))
 		if self.path.lstrip().startswith('#'):
 			testing_mode = True
 		if testing_mode:
 			text = "Did not start process:"
 		else:
-			self.history.append(int(time.time()))
+			self.history.append(int(cur_time()))
 			text = "Started process:"
 			dirname = os.path.dirname(self.path)
 			if not os.path.exists(dirname):
 				dirname = None
-			_que, self.thread = spawn(run_proc, self.path, log=log_file)
+			self.thread = launch(self.path, log_file)
 		eprint('\n' + local_time(), text, self.name, v=1)
 		if self.history:
 			print(joiner(', ', *self.history))
 
-		return True
+		return not testing_mode
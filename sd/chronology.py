@@ -3,16 +3,90 @@
 import re
 import sys
 import time
+import math
+import bisect
 import datetime
+import functools
 from collections import Counter
 from datetime import datetime as dada
 
 from sd.common import warn
 from sd.common import sig
-from sd.common import bisect_small, search_list
+
+class Clock:
+	'''The real clock. Time dependent code asks cur_time() instead of calling time.time()
+	so that set_clock(VirtualClock()) can run it in simulated time.'''
+	virtual = False
+
+	def time(self):
+		return time.time()
+
+	def monotonic(self):
+		return time.monotonic()
+
+	def sleep(self, seconds):
+		time.sleep(seconds)
+
+
+class VirtualClock(Clock):
+	"Simulated clock that only moves when told to"
+	virtual = True
+
+	def __init__(self, start=None):
+		self.now = time.time() if start is None else start
+		self.mono = 0
+
+	def time(self):
+		return self.now
+
+	def monotonic(self):
+		return self.mono
+
+	def sleep(self, seconds):
+		self.advance(seconds)
+
+	def advance(self, seconds):
+		"Move time forward"
+		seconds = max(seconds, 0)
+		self.now += seconds
+		self.mono += seconds
+
+	def suspend(self, seconds):
+		"Move the wall clock forward without the monotonic clock, like a computer in suspend"
+		self.now += seconds
+
+
+CLOCK = Clock()
+
+
+def set_clock(clock):
+	"Replace the clock used by cur_time(), localtime() and everything else in here"
+	global CLOCK        # pylint: disable=W0603
+	CLOCK = clock
+	return clock
+
+
+def get_clock():
+	return CLOCK
+
+
+def cur_time():
+	"time.time() from the current clock"
+	return CLOCK.time()
+
+
+def localtime(seconds=None):
+	"time.localtime() from the current clock"
+	return time.localtime(CLOCK.time() if seconds is None else seconds)
+
+
+def cur_date():
+	"Midnight this morning as a datetime"
+	return dada(*localtime()[:3])
+
 
 def int_time():
-	return int(time.time())
+	return int(cur_time())
 
 
 def strptime(text, fmt):
@@ -23,7 +97,7 @@ def strptime(text, fmt):
 def psleep(seconds):
 	"Sleep and tell us how long for"
 	print("Sleeping for", fmt_time(seconds, digits=2) + '...', file=sys.stderr)
-	time.sleep(seconds)
+	CLOCK.sleep(seconds)
 
 
 def msleep(seconds, accuracy=1/60):
@@ -31,9 +105,9 @@ def msleep(seconds, accuracy=1/60):
 	For example, if computer was in suspend mode.
 	Average error is about 100ms per 1000 seconds = .01%
 	'''
-	start = time.time()
-	time.sleep(seconds)
-	elapsed = time.time() - start
+	start = cur_time()
+	CLOCK.sleep(seconds)
+	elapsed = cur_time() - start
 	if elapsed / seconds > 1 + accuracy:
 		return elapsed - seconds
 	else:
@@ -66,6 +140,29 @@ def fmt_clock(num, smallest=None):
 		return s
 
 
+# For calculations involving leap years, use the datetime library:
+UNIT_LIMITS = (5.391e-44, 1e-24, 1e-21, 1e-18, 1e-15, 1e-12, 1e-09, 1e-06, 0.001, 1, 60,
+			   3600, 3600 * 24, 3600 * 24 * 7, 3600 * 24 * 30.4167, 3600 * 24 * 365.2422)
+UNIT_NAMES = (
+	'Planck time',
+	'yoctosecond',
+	'zeptosecond',
+	'attosecond',
+	'femtosecond',
+	'picosecond',
+	'nanosecond',
+	'microsecond',
+	'millisecond',
+	'second',
+	'minute',
+	'hour',
+	'day',
+	'week',
+	'month',
+	'year')
+UNIT_PLURALS = tuple(name + 's' for name in UNIT_NAMES)
+
+
 def fmt_time(num, digits=2, pretty=True, smallest=None, fields=None, zeroes='skip', **kargs):
 	'''Return a neatly formated time string.
 	sig         = the number of significant digits.
@@ -92,33 +189,13 @@ def fmt_time(num, digits=2, pretty=True, smallest=None, fields=None, zeroes='ski
 	if num < 5.391e-44:
 		return "0 seconds"
 	out = []
-	# For calculations involving leap years, use the datetime library:
-	limits = (5.391e-44, 1e-24, 1e-21, 1e-18, 1e-15, 1e-12, 1e-09, 1e-06, 0.001, 1, 60,
-			  3600, 3600 * 24, 3600 * 24 * 7, 3600 * 24 * 30.4167, 3600 * 24 * 365.2422)
-	names = (
-		'Planck time',
-		'yoctosecond',
-		'zeptosecond',
-		'attosecond',
-		'femtosecond',
-		'picosecond',
-		'nanosecond',
-		'microsecond',
-		'millisecond',
-		'second',
-		'minute',
-		'hour',
-		'day',
-		'week',
-		'month',
-		'year')
-
-	index = bisect_small(limits, num) + 1
+	limits = UNIT_LIMITS
+	index = max(bisect.bisect_right(limits, num) - 1, 0) + 1
 	while index > 0:
 		index -= 1
 		unit = limits[index]		#
 		u_num = num / unit          # unit number for current name
-		name = names[index]			# Unit name like weeks
+		name = UNIT_NAMES[index]	# Unit name like weeks
 
 		if name == 'week' and u_num < 2:
 			# Replace weeks with days when less than 2 weeks
@@ -131,7 +208,7 @@ def fmt_time(num, digits=2, pretty=True, smallest=None, fields=None, zeroes='ski
 			u_num = int(u_num)
 			if u_num == 0 and zeroes == 'skip':
 				continue
-			out += [str(u_num) + ' ' + name + ('s' if u_num != 1 else '')]
+			out += [str(u_num) + ' ' + (name if u_num == 1 else UNIT_PLURALS[index])]
 			num -= u_num * unit
 			if fr == 0:
 				break
@@ -149,7 +226,7 @@ def fmt_time(num, digits=2, pretty=True, smallest=None, fields=None, zeroes='ski
 		#In digits mode, output fields containing significant digits until seconds are reached, then stop
 		if num >= 60:     # Minutes or higher
 			u_num = int(u_num)
-			out += [str(u_num) + ' ' + name + ('s' if u_num != 1 else '')]
+			out += [str(u_num) + ' ' + (name if u_num == 1 else UNIT_PLURALS[index])]
 			digits -= len(str(u_num))
 			num -= u_num * unit
 			if digits <= 0:
@@ -157,7 +234,7 @@ def fmt_time(num, digits=2, pretty=True, smallest=None, fields=None, zeroes='ski
 		else:
 			# If time is less than a minute, just output last field and quit
 			d = digits if digits >= 1 else 1
-			out += [sig(u_num, d) + ' ' + name + ('s' if u_num != 1 else '')]
+			out += [sig(u_num, d) + ' ' + (name if u_num == 1 else UNIT_PLURALS[index])]
 			break
 
 	return ', '.join(out)
@@ -174,10 +251,10 @@ for exp in range(-22,66):
 
 def seconds_since_midnight(seconds=None):
 	if seconds:
-		tim = time.localtime(seconds)
+		tim = localtime(seconds)
 	else:
-		tim = time.localtime()
-	return tim.tm_hour * 3600 + tim.tm_min * 60 + tim.tm_sec + time.time() % 1
+		tim = localtime()
+	return tim.tm_hour * 3600 + tim.tm_min * 60 + tim.tm_sec + cur_time() % 1
 
 
 def diff_days(*args):
@@ -190,7 +267,7 @@ def diff_days(*args):
 		end = args[1]
 	else:
 		end = args[0]
-		start = time.time()
+		start = cur_time()
 	diff = (dada.fromtimestamp(end) - dada.fromtimestamp(start))
 	return diff.days + diff.seconds / 86400  # + diff.microseconds/86400e6
 
@@ -211,30 +288,82 @@ for months in range(22):
 '''
 
 
-def local_time(timestamp=None, user_format=None):
-	'''Given a unix timestamp, show the local time in a nice format:
-	By default will not show date, unless more than a day into future.Format info here:
-	https://docs.python.org/3.5/library/time.html#time.strftime '''
-	if not timestamp:
-		timestamp = time.time()
-
-	if user_format:
-		fmt = user_format
-	else:
+class TimeFormatter:
+	'''Format lots of timestamps and durations quickly.
+	The boundaries of today and this month are worked out once and reused until the day changes,
+	so each timestamp only needs one call to time.localtime()'''
+
+	def __init__(self):
+		self.day = (0, 0)           # Start and end of today in unix time
+		self.month = (0, 0)         # Start and end of this month
+		self.offsets = (0, 0)       # UTC offset at the start and end of today
+
+	def refresh(self, now):
+		"Recalculate the day and month boundaries if now isn't today"
+		if self.day[0] <= now < self.day[1]:
+			return
+		midnight = dada(*time.localtime(now)[:3])
+		start = midnight.timestamp()
+		end = (midnight + datetime.timedelta(days=1)).timestamp()
+		self.day = start, end
+		self.month = midnight.replace(day=1).timestamp(), add_date(midnight.replace(day=1), months=1).timestamp()
+		self.offsets = time.localtime(start).tm_gmtoff, time.localtime(end - 1).tm_gmtoff
+
+	def utc_offset(self, now):
+		"UTC offset at now, only asking time.localtime() on days when daylight saving time changes"
+		if self.offsets[0] == self.offsets[1]:
+			return self.offsets[0]
+		return time.localtime(now).tm_gmtoff
+
+	def local(self, timestamp=None, user_format=None, now=None):
+		"Same as local_time(). now = current time to compare against"
+		if now is None:
+			now = cur_time()
+		if not timestamp:
+			timestamp = now
+		tim = time.localtime(timestamp)
+		if user_format:
+			return time.strftime(user_format, tim)
+
+		self.refresh(now)
 		fmt = '%I:%M %p'
-		if timestamp and time.localtime()[:3] != time.localtime(timestamp)[:3]:
-			if time.localtime()[:2] != time.localtime(timestamp)[:2]:
+		if not self.day[0] <= timestamp < self.day[1]:
+			if not self.month[0] <= timestamp < self.month[1]:
 				# New month
 				fmt = '%Y-%m-%d'
+			elif (timestamp - now + tim.tm_gmtoff - self.utc_offset(now)) / 86400 < 7:
+				# New day of week
+				fmt = '%a %I:%M %p'
 			else:
-				if diff_days(timestamp) < 7:
-					# New day of week
-					fmt = '%a %I:%M %p'
-				else:
-					# New day in same month
-					fmt = '%m-%d %I:%M %p'
+				# New day in same month
+				fmt = '%m-%d %I:%M %p'
+		return time.strftime(fmt, tim)
+
+	def local_many(self, timestamps, user_format=None, never='never'):
+		"local_time() for a list of timestamps, all compared to the same now. Infinite ones are shown as never"
+		now = cur_time()
+		return [never if math.isinf(timestamp) else self.local(timestamp, user_format, now) for timestamp in timestamps]
+
+	@staticmethod
+	def durations(nums, never='never', **kargs):
+		"fmt_time() for a list of numbers. Repeated numbers are only formatted once. Infinite ones are shown as never"
+		done = dict()
+		out = []
+		for num in nums:
+			if num not in done:
+				done[num] = never if math.isinf(num) else fmt_time(num, **kargs)
+			out.append(done[num])
+		return out
 
-	return time.strftime(fmt, time.localtime(timestamp))
+
+FORMATTER = TimeFormatter()
+
+
+def local_time(timestamp=None, user_format=None):
+	'''Given a unix timestamp, show the local time in a nice format:
+	By default will not show date, unless more than a day into future.Format info here:
+	https://docs.python.org/3.5/library/time.html#time.strftime '''
+	return FORMATTER.local(timestamp, user_format)
 
 '''
 	print(local_time(time.time() + 1e2))
@@ -242,11 +371,42 @@ def local_time(timestamp=None, user_format=None):
 	print(local_time(time.time() + 1e8))
 '''
 
+class PrefixIndex:
+	'''Sorted names for finding every name that starts with some text by bisecting
+	instead of checking each name in turn like search_list'''
+
+	def __init__(self, names):
+		pairs = sorted((name.lower(), name) for name in names)
+		self.keys = [pair[0] for pair in pairs]
+		self.names = [pair[1] for pair in pairs]
+
+	def matches(self, prefix):
+		"Return every name starting with prefix, ignoring case"
+		prefix = prefix.lower()
+		start = bisect.bisect_left(self.keys, prefix)
+		end = bisect.bisect_left(self.keys, prefix + chr(0x10ffff), start)
+		return self.names[start:end]
+
+
+_INDEXES = dict()       # id of conversions dict to (dict, size, PrefixIndex)
+
+
+def prefix_index(conversions):
+	"Return a PrefixIndex of the dict keys, reusing the last one built for that dict"
+	entry = _INDEXES.get(id(conversions))
+	if not entry or entry[0] is not conversions or entry[1] != len(conversions):
+		if len(_INDEXES) > 64:
+			_INDEXES.clear()
+		entry = conversions, len(conversions), PrefixIndex(conversions)
+		_INDEXES[id(conversions)] = entry
+	return entry[2]
+
+
 def match_conversion(text, conversions):
 	"match text against a list of conversions"
 	if text in conversions:
 		return conversions[text]
-	matches = search_list(text, conversions.keys())
+	matches = prefix_index(conversions).matches(text)
 	if len(matches) == 1:
 		return conversions[matches[0]]
 	elif len(matches) > 1:
@@ -260,6 +420,43 @@ def match_conversion(text, conversions):
 	return None
 
 
+# Per convention with datetime, weeks start on monday
+WEEKDAYS = dict(
+	m=0,
+	monday=0,
+	munday=0,
+	t=1,
+	tu=1,
+	tuesday=1,
+	tuseday=1,
+	twosday=1,
+	toosday=1,
+	w=2,
+	wednesday=2,
+	wensday=2,
+	r=3,
+	h=3,
+	th=3,
+	thursday=3,
+	thorsday=3,
+	f=4,
+	friday=4,
+	fryday=4,
+	s=5,
+	saturday=5,
+	u=6,
+	sunday=6,
+)
+
+MONTHS = {name: num for num, name in enumerate('jan feb mar apr may jun jul aug sep oct nov dec'.split(), 1)}
+
+COUNT_RE = re.compile('^[0-9][0-9]*')
+COUNT_SHORT_RE = re.compile('^[0-9]*[^ ]{0,2}')
+COUNT_WORD_RE = re.compile('^[0-9]*[^ ]{0,2} ')
+NOT_DIGITS_RE = re.compile('[^0-9]*')
+LEADING_TEXT_RE = re.compile('^[^0-9]*')
+
+
 def udate(text):
 	'''
 	Convert a user formatted date into a number of days and length of cycle
@@ -267,20 +464,30 @@ def udate(text):
 	3-7 = days of month, January 9, January 9th, Jan 2nd (throw away 2 digits after number)
 	Per convention with datetime, weeks start on monday
 	'''
-	text = str(text).strip().lower()
+	value, cycle = _parse_udate(str(text).strip().lower())
+	if cycle == 'year':
+		# Only the month and day are cached, the year always comes from today
+		month, day = value
+		return cur_date().replace(month=month, day=day), cycle
+	return value, cycle
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_udate(text):
+	"The cached part of udate. Dates in a year are returned as (month, day)"
 	digits = sum([char.isdigit() for char in text])
 
 	#Extract count (if available)
 	#Example: Every 2nd Tuesday
 	count = 1
 	if digits < len(text):
-		match = re.match('^[0-9][0-9]*', text)
+		match = COUNT_RE.match(text)
 		if match and len(match.group()) > 0:
 			count = int(match.group())
 			if len(text) <= 4:
-				text = re.sub('^[0-9]*[^ ]{0,2}', '', text)
+				text = COUNT_SHORT_RE.sub('', text, count=1)
 			if ' ' in text:
-				text = re.sub('^[0-9]*[^ ]{0,2} ', '', text)
+				text = COUNT_WORD_RE.sub('', text, count=1)
 
 
 	#Count the remaining digits
@@ -293,47 +500,22 @@ def udate(text):
 
 	# Match Tu T = Tuesday
 	if digits == 0 and text:
-		days = dict(
-			m=0,
-			monday=0,
-			munday=0,
-			t=1,
-			tu=1,
-			tuesday=1,
-			tuseday=1,
-			twosday=1,
-			toosday=1,
-			w=2,
-			wednesday=2,
-			wensday=2,
-			r=3,
-			h=3,
-			th=3,
-			thursday=3,
-			thorsday=3,
-			f=4,
-			friday=4,
-			fryday=4,
-			s=5,
-			saturday=5,
-			u=6,
-			sunday=6,
-		)
 		if len(text) >= 2:
 			text = text.rstrip('s')
-		new = match_conversion(text, days)
+		new = match_conversion(text, WEEKDAYS)
 		if new is not None:
 			return (count - 1) * 7 + new, 'week'
 
 	# March 3
 	if digits < len(text):
 		day = 1
-		month = time.strptime(text[:3], '%b').tm_mon
-		text = re.sub('^[^0-9]*', '', text).strip()
+		month = MONTHS.get(text[:3])
+		if not month:
+			raise ValueError("Unknown month: " + text)
+		text = LEADING_TEXT_RE.sub('', text, count=1).strip()
 		if text:
-			day = int(re.sub('[^0-9]*', '', text))
-		today = dada(*dada.now().timetuple()[:3])
-		return today.replace(month=month, day=day), 'year'
+			day = int(NOT_DIGITS_RE.sub('', text))
+		return (month, day), 'year'
 
 
 	# Just digits
@@ -360,7 +542,12 @@ while True:
 
 def convert_ut_range(unum, **kargs):
 	"User time ranges like 3-5pm to machine readable"
-	unum = unum.lower().strip().split('-')
+	return list(_convert_ut_range(unum.lower().strip(), **kargs))
+
+
+@functools.lru_cache(maxsize=1024)
+def _convert_ut_range(unum, **kargs):
+	unum = unum.split('-')
 	count = Counter([item[-2:] for item in unum])
 	pm = count['pm']
 	am = count['am']
@@ -375,81 +562,91 @@ def convert_ut_range(unum, **kargs):
 					if value is not None and convert_user_time(unum[x]) < value:
 						continue
 					unum[x] = unum[x] + unit
-	return [convert_user_time(item, **kargs) for item in unum]
+	return tuple(convert_user_time(item, **kargs) for item in unum)
 
 # Test: lmap(fmt_time, *convert_ut_range('3-5pm'))
 
 
+DAY = 3600 * 24
+YEAR = 365.2422 * DAY
+
+CONVERSIONS = dict(
+	seconds=1,
+	minutes=60,
+	hours=3600,
+	days=DAY,
+	weeks=7 * DAY,
+	months=30.4167 * DAY,
+	years=YEAR,
+	decades=10 * YEAR,
+	centuries=100 * YEAR,
+	century=100 * YEAR,
+	millenia=1000 * YEAR,
+	millenium=1000 * YEAR,
+
+	# Esoteric:
+	fortnight=14 * DAY,
+	quarter=30.4167 * DAY * 3,
+	jubilees=50 * YEAR,
+	biennium=2 * YEAR,
+	gigasecond=1e9,
+	aeons=1e9 * YEAR, eons=1e9 * YEAR,
+	jiffy=1 / 60, jiffies=1 / 60,
+	shakes=1e-8,
+	svedbergs=1e-13,
+	decasecond=10,
+	hectosecond=100,
+
+	# Nonstandard years
+	tropicalyears=365.24219 * DAY,
+	gregorianyears=YEAR,
+	siderealyears=365.242190 * DAY,
+
+	# <1 second
+	plancktimes=5.391e-44, plancks=5.391e-44,
+	yoctoseconds=1e-24, ys=1e-24,
+	zeptoseconds=1e-21, zs=1e-21,
+	attoseconds=1e-18,
+	femtoseconds=1e-15, fs=1e-15,
+	picoseconds=1e-12, ps=1e-12,
+	nanoseconds=1e-09, ns=1e-9,
+	microseconds=1e-06, us=1e-6,
+	milliseconds=1e-3, ms=1e-3)
+CONVERSIONS['as'] = 1e-18
+
+# Every prefix of the primary units mapped to the first unit it matches so that 3m means minutes, not months
+PRIMARY_UNITS = "seconds minutes hours days months years".split()
+PRIMARY_PREFIXES = dict()
+for _unit in PRIMARY_UNITS:
+	for _end in range(len(_unit) + 1):
+		PRIMARY_PREFIXES.setdefault(_unit[:_end], _unit)
+
+TWELVE_AM_RE = re.compile('12[^1234567890].*am')
+
+
 def convert_user_time(unum, default='seconds'):
 	'''Convert a user input time like 3.14 days to seconds
 	Valid: 3h, 3 hours, 3 a.m., 3pm, 3:14 am, 3:14pm'''
-	unum = str(unum).strip().lower()
+	return _convert_user_time(str(unum).strip().lower(), default)
+
+
+convert_user_time.conversions = CONVERSIONS
+
+
+@functools.lru_cache(maxsize=4096)
+def _convert_user_time(unum, default):
 	if ',' in unum:
 		return sum(map(convert_user_time, unum.split(',')))
 	if not unum:
 		return 0
 
-	# Build conversion table
-	self = convert_user_time
-	if not hasattr(self, 'conversions'):
-		day = 3600 * 24
-		year = 365.2422 * day
-
-		self.conversions = dict(
-			seconds=1,
-			minutes=60,
-			hours=3600,
-			days=day,
-			weeks=7 * day,
-			months=30.4167 * day,
-			years=year,
-			decades=10 * year,
-			centuries=100 * year,
-			century=100 * year,
-			millenia=1000 * year,
-			millenium=1000 * year,
-
-			# Esoteric:
-			fortnight=14 * day,
-			quarter=30.4167 * day * 3,
-			jubilees=50 * year,
-			biennium=2 * year,
-			gigasecond=1e9,
-			aeons=1e9 * year, eons=1e9 * year,
-			jiffy=1 / 60, jiffies=1 / 60,
-			shakes=1e-8,
-			svedbergs=1e-13,
-			decasecond=10,
-			hectosecond=100,
-
-			# Nonstandard years
-			tropicalyears=365.24219 * day,
-			gregorianyears=year,
-			siderealyears=365.242190 * day,
-
-			# <1 second
-			plancktimes=5.391e-44, plancks=5.391e-44,
-			yoctoseconds=1e-24, ys=1e-24,
-			zeptoseconds=1e-21, zs=1e-21,
-			attoseconds=1e-18,
-			femtoseconds=1e-15, fs=1e-15,
-			picoseconds=1e-12, ps=1e-12,
-			nanoseconds=1e-09, ns=1e-9,
-			microseconds=1e-06, us=1e-6,
-			milliseconds=1e-3, ms=1e-3)
-		self.conversions['as'] = 1e-18
-	conversions = self.conversions
-
-	# Primary units
-	primary = "seconds minutes hours days months years".split()
-
 	# 12 am fix
-	if re.match('12[^1234567890].*am', unum) or unum == '12am':
+	if TWELVE_AM_RE.match(unum) or unum == '12am':
 		unum = unum.replace('12', '0')
 
-	# Text processing:
+	# Split into the number and the unit
 	text = unum.lstrip('0123456789. \t:')
-	num = unum.replace(text, '').strip()
+	num = (unum[:-len(text)] if text else unum).strip()
 
 	if ':' in num:
 		# Convert a num like 3:14:60 into fractions of 60
@@ -466,13 +663,12 @@ def convert_user_time(unum, default='seconds'):
 		elif text == 'pm':
 			return num * 3600 + 12 * 3600
 		else:
-			# Match the text with the first unit found in units so that 3m matches minutes, not months
-			unit = search_list(text, primary, getfirst=True)
+			unit = PRIMARY_PREFIXES.get(text)
 			if not unit:
 				# Otherwise search for less commonly used units in entire list
-				unit = match_conversion(text, conversions)
+				unit = match_conversion(text, CONVERSIONS)
 			else:
-				unit = conversions[unit]
+				unit = CONVERSIONS[unit]
 			return num * unit
 	else:
-		return num * conversions[default]
+		return num * CONVERSIONS[default]
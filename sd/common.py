@@ -440,6 +440,16 @@ def sig(num, digits=3):
 		return negative + str(int(num))
 
 
+def convert_user_size(text, default='b'):
+	'''Convert a user input size like 10M, 1.5 GB or 512kib to bytes.
+	Units are powers of 1024. A number without a unit is in default units'''
+	match = re.match(r'^([0-9.]+)\s*([bkmgtpe]?)i?b?$', str(text).strip().lower())
+	if not match:
+		raise ValueError("Can't read size: " + str(text))
+	num, unit = match.groups()
+	return int(float(num) * 1024 ** 'bkmgtpe'.index(unit or default[0].lower()))
+
+
 def debug_pass(*args, **kargs):         # pylint: disable=unused-argument
 	"Drop in replacement to disable debug lines"
 	pass    # pylint: disable=unnecessary-pass
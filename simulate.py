@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+# Run the daemon against a simulated clock to see what a schedule would do over days or weeks.
+# Usage: ./LazyCron.py --simulate 30d --timeline timeline.txt
+
+import io
+import os
+import sys
+import datetime
+import contextlib
+from datetime import datetime as dada
+
+import scheduler
+from daemon import Daemon
+from journal import Journal
+from history import RunHistory
+from idle_time import IdleSource
+
+from sd.common import itercount, read_csv, error
+from sd.chronology import VirtualClock, set_clock, get_clock, cur_time, local_time, fmt_time, convert_user_time
+
+'''
+Timeline format, tab seperated like the schedule file:
+	Time        Date        State
+	9am-6pm     m-f         active
+	10pm-7am    *           unplugged, closed
+
+active    = Someone is using the computer. Otherwise it counts as idle.
+unplugged = Running on battery. Otherwise plugged in.
+closed    = Lid is closed. Otherwise open.
+'''
+
+DEFAULT_TIMELINE = [['9am-6pm', 'm-f', 'active']]
+STATES = ('active', 'unplugged', 'closed')
+
+
+SEARCH_DAYS = 366 * 4 + 1      # Far enough ahead to find a February 29th
+
+
+def in_range(value, first, last):
+	"Is value between first and last, wrapping around if last comes before first (like fri-mon)"
+	if first <= last:
+		return first <= value <= last
+	return value >= first or value <= last
+
+
+def allowed_day(day, date_window):
+	"Does the date object day match any of the (start, end, cycle) rules in date_window?"
+	for first, last, cycle in date_window:
+		if cycle == 'week':
+			if first >= 7 or last >= 7:
+				# Counted weekdays like 2nd Thursday = 7 + 3 are the nth one in the month
+				if in_range((day.day - 1) // 7 * 7 + day.weekday(), first, last):
+					return True
+			elif in_range(day.weekday(), first, last):
+				return True
+		elif cycle == 'month':
+			if in_range(day.day, first, last):
+				return True
+		elif in_range((day.month, day.day), (first.month, first.day), (last.month, last.day)):
+			return True
+	return False
+
+
+class TimelineRule(scheduler.Scheduler):
+	'''One line of the timeline. Unlike the schedule, the time repeats on every day in the date range:
+	9am-6pm with m-f is at the computer each weekday, not from Monday morning to Friday evening.'''
+
+	def windows(self, after=None):
+		"Yield every (start, stop) window in unix time that hasn't closed by after, in order"
+		if after is None:
+			after = cur_time()
+		day = dada.fromtimestamp(after).date() - datetime.timedelta(days=1)
+		times = sorted((start, stop + 86400 if stop < start else stop) for start, stop in self.window) or [(0, 86399)]
+		for _ in range(SEARCH_DAYS):
+			if not self.date_window or allowed_day(day, self.date_window):
+				midnight = dada.combine(day, datetime.time())
+				for start, stop in times:
+					stop = (midnight + datetime.timedelta(seconds=stop)).timestamp()
+					if stop >= after:
+						yield (midnight + datetime.timedelta(seconds=start)).timestamp(), stop
+			day += datetime.timedelta(days=1)
+
+
+class Timeline:
+	"When the simulated user is at the computer, when it's unplugged and when the lid is closed"
+
+	def __init__(self, filename=None):
+		self.rules = {state: [] for state in STATES}
+		rows = read_csv(filename, delimiter=("\t", " " * 4), merge=True) if filename else DEFAULT_TIMELINE
+		for row in rows:
+			row = [str(item) for item in row]
+			if len(row) != 3:
+				error("Timeline lines need 3 columns (time, date, state):", row)
+			for state in row[2].split(','):
+				state = state.strip().lower()
+				if state not in self.rules:
+					error("Unknown state:", state, "Use one of", ', '.join(STATES))
+				# Reuse the schedule parser to work out the time windows
+				line = dict(time=row[0], frequency='*', date=row[1], reqs='*', priority='*', path=state)
+				self.rules[state].append(TimelineRule(line))
+
+	@staticmethod
+	def in_effect(rule, now):
+		if now > rule.stop:
+			rule.calc_window()
+		return rule.start <= now <= rule.stop
+
+	def current(self, state):
+		"Return the rules for state that cover the current time"
+		now = cur_time()
+		return [rule for rule in self.rules[state] if self.in_effect(rule, now)]
+
+	def edges(self):
+		"Yield the next time each rule starts or stops"
+		now = cur_time()
+		for rules in self.rules.values():
+			for rule in rules:
+				yield (rule.stop + 1 if self.in_effect(rule, now) else rule.start), rule.path
+
+
+class TimelineIdle(IdleSource):
+	"Idle time from the timeline: zero while active, otherwise counting up from the end of the last active window"
+	name = 'timeline'
+
+	def __init__(self, timeline):
+		self.timeline = timeline
+		self.active_until = cur_time()
+
+	def query(self):
+		active = self.timeline.current('active')
+		if active:
+			self.active_until = max(rule.stop for rule in active)
+			return 0
+		return max(0, cur_time() - self.active_until)
+
+
+class TimelineSensors:
+	"Lid and power cord from the timeline, in place of scheduler.SENSORS"
+
+	def __init__(self, timeline):
+		self.timeline = timeline
+
+	def lid_open(self):
+		return not self.timeline.current('closed')
+
+	def is_plugged(self):
+		return not self.timeline.current('unplugged')
+
+
+class SimJob:
+	"Stands in for a job thread. Simulated jobs finish instantly"
+
+	@staticmethod
+	def is_alive():
+		return False
+
+
+class SimDaemon(Daemon):
+	'''The daemon with the clock, idle time, power and lid all coming from the timeline.
+	Nothing is launched and no state is saved.'''
+
+	def __init__(self, args, timeline):
+		self.timeline = timeline
+		self.runs = []              # (time, proc)
+		self.suspends = []          # (time, seconds asleep)
+		super().__init__(args)
+
+	def open_journal(self):
+		return Journal(os.devnull, readonly=True)
+
+	def open_history(self):
+		return RunHistory(':memory:', readonly=True)
+
+	def open_cache(self):
+		return None
+
+	def open_idle_source(self):
+		return TimelineIdle(self.timeline)
+
+	def open_sensors(self):
+		return TimelineSensors(self.timeline)
+
+	def open_metrics(self):
+		return None
+
+	def watch_schedule(self):
+		"The schedule is only read once"
+
+	def start_sampler(self):
+		return None
+
+	def query_busy(self):
+		return True, False
+
+	def launch(self, cmd, log, proc=None):
+		return SimJob()
+
+	def start_job(self, proc, testing):
+		super().start_job(proc, testing)
+		self.runs.append((cur_time(), proc))
+
+	def suspend(self):
+		"Sleep until the user comes back"
+		now = cur_time()
+		starts = [rule.start for rule in self.timeline.rules['active'] if rule.start > now]
+		if starts:
+			self.suspends.append((now, min(starts) - now))
+			get_clock().suspend(min(starts) - now)
+			# Same as Daemon.woke() after time goes missing
+			self.total_idle = self.query_idle()
+			self.timestamp = cur_time()
+
+	def plan_wakeups(self):
+		super().plan_wakeups()
+		for when, state in self.timeline.edges():
+			self.wakeup.push(when, state + ' changes')
+
+
+def simulate(args):
+	"Run the schedule for args.simulate worth of simulated time and print when each app would run"
+	duration = convert_user_time(args.simulate, default='days')
+	clock = set_clock(VirtualClock())
+	start = clock.time()
+	end = start + duration
+	timeline = Timeline(args.timeline)
+
+	quiet = io.StringIO()
+	with contextlib.redirect_stdout(sys.stdout if args.verbose >= 2 else quiet), \
+		 contextlib.redirect_stderr(sys.stderr if args.verbose >= 2 else quiet):
+		lazy = SimDaemon(args, timeline)
+		for counter in itercount():
+			if counter and not lazy.sleep(counter):
+				continue
+			if clock.time() >= end:
+				break
+			lazy.tick(counter)
+			lazy.wakeup.push(end, 'end of simulation')
+
+	print('Simulated', fmt_time(duration), 'from', local_time(start, '%a %m-%d %I:%M %p'), 'to',
+		  local_time(end, '%a %m-%d %I:%M %p'), 'in', counter, 'loops')
+	print('Active time:', fmt_time(lazy.elapsed))
+	if lazy.suspends:
+		print('Suspended', len(lazy.suspends), 'times for', fmt_time(sum(secs for _when, secs in lazy.suspends)))
+	print()
+	for proc in lazy.schedule_apps:
+		times = [when for when, ran in lazy.runs if ran is proc]
+		print(proc.name, 'ran', len(times), 'times')
+		if args.verbose:
+			for when in times:
+				print('\t' + local_time(when, '%a %m-%d %I:%M %p'))
+	return lazy.runs
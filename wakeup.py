@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+# Sleep until something interesting happens instead of polling on a fixed interval.
+
+import os
+import heapq
+import select
+import struct
+import ctypes
+import ctypes.util
+from collections import deque
+
+from sd.chronology import cur_time, get_clock
+
+
+LIBC = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+# From <sys/timerfd.h> and <sys/inotify.h>
+CLOCK_REALTIME = 0
+TFD_TIMER_ABSTIME = 1
+TFD_NONBLOCK = os.O_NONBLOCK
+TFD_CLOEXEC = os.O_CLOEXEC
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_EVENT = struct.Struct('iIII')
+
+
+class _Timespec(ctypes.Structure):
+	_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+class _Itimerspec(ctypes.Structure):
+	_fields_ = [('it_interval', _Timespec), ('it_value', _Timespec)]
+
+
+def open_timerfd():
+	'''Open a timer on the wall clock that fires at an absolute time.
+	Unlike time.sleep it still goes off on time after the computer resumes from suspend.
+	Returns None if not available'''
+	try:
+		fd = LIBC.timerfd_create(CLOCK_REALTIME, TFD_NONBLOCK | TFD_CLOEXEC)
+	except AttributeError:
+		return None
+	return fd if fd >= 0 else None
+
+
+def arm_timerfd(fd, when):
+	"Set the timer to go off at unix time: when"
+	spec = _Itimerspec()
+	spec.it_value.tv_sec = int(when)
+	spec.it_value.tv_nsec = int((when % 1) * 1e9)
+	if LIBC.timerfd_settime(fd, TFD_TIMER_ABSTIME, ctypes.byref(spec), None) < 0:
+		raise OSError(ctypes.get_errno(), "timerfd_settime failed")
+
+
+def drain(fd, size=4096):
+	"Read everything waiting on a non blocking fd"
+	data = b''
+	while True:
+		try:
+			chunk = os.read(fd, size)
+		except (BlockingIOError, InterruptedError):
+			return data
+		if not chunk:
+			return data
+		data += chunk
+
+
+class WakeQueue:
+	'''Priority queue of upcoming instants worth waking up for.
+	sleep() rests until the earliest one, or until woken early by wake() or a watched file changing.'''
+
+	def __init__(self):
+		self.heap = []                  # (unix time, reason)
+		self.woken = deque()            # Reasons given to wake() since last sleep
+		self.reasons = []               # Why the last sleep ended
+		self.pipe_r, self.pipe_w = os.pipe()
+		os.set_blocking(self.pipe_r, False)
+		os.set_blocking(self.pipe_w, False)
+		self.timer = open_timerfd()
+		self.inotify = None             # inotify file descriptor
+		self.watches = dict()           # watch descriptor to set of filenames in that directory
+
+	def push(self, when, reason):
+		"Add an instant to wake up at"
+		heapq.heappush(self.heap, (when, reason))
+
+	def clear(self):
+		self.heap.clear()
+
+	def earliest(self):
+		"Return the next (time, reason) or (inf, None) if nothing is queued"
+		if self.heap:
+			return self.heap[0]
+		return float('inf'), None
+
+	def wake(self, reason='external'):
+		"Interrupt sleep(). Safe to call from other threads and signal handlers."
+		self.woken.append(reason)
+		try:
+			os.write(self.pipe_w, b'!')
+		except BlockingIOError:
+			pass            # Pipe is already full of wakeups
+
+	def watch(self, filename):
+		'''Wake up when filename is written or replaced. Returns False if inotify is unavailable
+		Watches the directory, because most editors save by replacing the file.'''
+		if self.inotify is None:
+			try:
+				fd = LIBC.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+			except AttributeError:
+				return False
+			if fd < 0:
+				return False
+			self.inotify = fd
+		dirname = os.path.dirname(os.path.abspath(filename))
+		wd = LIBC.inotify_add_watch(self.inotify, dirname.encode(), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+		if wd < 0:
+			return False
+		self.watches.setdefault(wd, set()).add(os.path.basename(filename))
+		return True
+
+	def read_woken(self):
+		"Return the reasons given to wake() since last called"
+		drain(self.pipe_r)
+		reasons = []
+		while self.woken:
+			reasons.append(self.woken.popleft())
+		return reasons
+
+	def read_changes(self):
+		"Return list of watched files that changed"
+		data = drain(self.inotify)
+		changed = []
+		offset = 0
+		while offset + IN_EVENT.size <= len(data):
+			wd, _mask, _cookie, length = IN_EVENT.unpack_from(data, offset)
+			offset += IN_EVENT.size
+			name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+			offset += length
+			if name in self.watches.get(wd, ()):
+				changed.append(name)
+		return changed
+
+	def _wait(self, deadline, cap):
+		"Wait until deadline or an external event. Returns list of reasons"
+		fds = [self.pipe_r]
+		if self.inotify is not None:
+			fds.append(self.inotify)
+		if self.timer is not None and deadline < float('inf'):
+			arm_timerfd(self.timer, deadline)
+			fds.append(self.timer)
+
+		while True:
+			remaining = deadline - cur_time()
+			if remaining <= 0:
+				return ['timer']
+			# Without a timerfd, time spent in suspend isn't counted by select, so wake up every cap seconds to check
+			ready = select.select(fds, [], [], min(remaining, cap))[0]
+			if not ready:
+				continue
+			reasons = []
+			if self.pipe_r in ready:
+				reasons += self.read_woken()
+			if self.inotify in ready:
+				reasons += ['changed ' + name for name in self.read_changes()]
+			if self.timer in ready:
+				drain(self.timer)
+				reasons.append('timer')
+			if reasons:
+				return reasons
+
+	def pop_due(self):
+		"Drop anything that has come due"
+		now = cur_time()
+		while self.heap and self.heap[0][0] <= now:
+			heapq.heappop(self.heap)
+
+	def sleep(self, cap, accuracy=1/60):
+		'''Sleep until the earliest queued instant, but no longer than cap seconds.
+		Returns the amount of missing time during sleep (from suspend) like msleep'''
+		clock = get_clock()
+		start = clock.time()
+		mono = clock.monotonic()
+		when, _reason = self.earliest()
+		if clock.virtual:
+			# Simulated time: jump straight to the deadline unless something already called wake()
+			self.reasons = self.read_woken() or ['timer']
+			if self.reasons == ['timer']:
+				clock.advance(min(when, start + cap) - start)
+		else:
+			self.reasons = self._wait(min(when, start + cap), cap)
+		self.pop_due()
+		return missing_time(start, mono, accuracy)
+
+
+def missing_time(start, mono, accuracy=1/60):
+	'''Given the clock's time() and monotonic() readings from before a sleep,
+	return the seconds spent in suspend or 0. The monotonic clock doesn't count them.'''
+	clock = get_clock()
+	elapsed = clock.time() - start
+	missing = elapsed - (clock.monotonic() - mono)
+	if missing > 1 + elapsed * accuracy:
+		return missing
+	return 0